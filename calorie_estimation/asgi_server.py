@@ -0,0 +1,219 @@
+import os
+import json
+import asyncio
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from async_utility import calorie_estimation, yolo_detection, server_stats, model_manager, analyze_image, \
+    calorie_result_cache, calorie_cache_key, DEPTH_BATCH_MAX_SIZE
+from image_frame import ImageFrame
+from timing import StageTimer
+from device_workers import DeviceWorkerPool, QueueFull
+from metrics import metrics, server_timing
+from quality_tiers import QUALITY_TIERS, tier_selector
+
+# Requests allowed to wait per device worker before new ones are rejected with 503
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 8))
+# Requests each device runs at once. With one, depth forwards reach the batcher one at a time and
+# are never batched, so the default lets a full depth batch be in flight.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', max(1, DEPTH_BATCH_MAX_SIZE)))
+
+worker_pool = DeviceWorkerPool(model_manager.devices, max_queue_size=WORKER_QUEUE_SIZE,
+                               concurrency=WORKER_CONCURRENCY)
+metrics.add_collector(lambda: [('calorie_worker_queue_depth', 'Requests waiting for each device worker',
+                                [({'device': str(w.device)}, w.pending()) for w in worker_pool.workers])])
+
+
+def to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class NumpyJSONResponse(JSONResponse):
+    def render(self, content):
+        return json.dumps(content, default=to_builtin).encode('utf-8')
+
+
+def timed_response(result, timer, tier=None):
+    # Serializes the result and reports every stage of the request in a Server-Timing header
+    timer.device = None  # Model work has finished, serializing must not wait on other requests' GPU work
+    with timer.stage('serialize'):
+        response = NumpyJSONResponse(result)
+    metrics.observe('serialize', timer.timings['serialize'])
+    response.headers['Server-Timing'] = server_timing(timer.timings)
+    if tier is not None:
+        response.headers['X-Quality-Tier'] = tier
+    return response
+
+
+def requested_tier(request, form):
+    # Quality tier forced by the client as a form field or query parameter, None leaves the
+    # choice to the tier selector
+    return form.get('tier') or request.query_params.get('tier') or None
+
+
+def unknown_tier_response():
+    return PlainTextResponse(f'Unknown quality tier, expected one of {list(QUALITY_TIERS)}', status_code=400)
+
+
+async def decode(image_data, timer):
+    # Decode and resize off the event loop
+    loop = asyncio.get_running_loop()
+    with timer.stage('decode'):
+        frame = await loop.run_in_executor(None, ImageFrame.from_bytes, image_data)
+    metrics.observe('decode', timer.timings['decode'])
+    return frame
+
+
+def queue_full_response(error):
+    return PlainTextResponse('Server busy', status_code=503, headers={'Retry-After': str(error.retry_after)})
+
+
+async def run_on_worker(fn, frame, *args, **kwargs):
+    # Each CPU worker process has its own SAM embedding cache, so an image goes to the same one
+    affinity = int(frame.digest()[:8], 16) if model_manager.cpu_workers else None
+    return await asyncio.wrap_future(worker_pool.submit(fn, frame, *args, affinity=affinity, **kwargs))
+
+
+# Result cache fills in progress, referenced so the event loop doesn't drop the tasks
+cache_fills = set()
+
+
+async def fill_calorie_cache(key, future, image_data, detected_objects, timer, tier, forced):
+    # Computes a claimed key as its own task, so cancelling the request that claimed it does not
+    # fail the others waiting on the same key
+    try:
+        frame = await decode(image_data, timer)
+        result = await run_on_worker(calorie_estimation, frame, detected_objects, timer=timer, tier=tier,
+                                     forced=forced)
+    except BaseException as e:  # Including cancellation, waiters must not hang on the key
+        calorie_result_cache.fail(key, future, e)
+        if not isinstance(e, Exception):
+            raise
+        return  # Passed to the waiters through the future
+    calorie_result_cache.complete(key, future, result)
+
+
+async def wait_shared(future):
+    # Waits on a concurrent Future shared by several requests. asyncio.wrap_future would cancel it
+    # when this waiter is cancelled, failing every other waiter, so each waiter copies the outcome
+    # into its own asyncio future instead.
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def copy(source):
+        if waiter.done():
+            return  # This waiter was cancelled
+        if source.cancelled():
+            waiter.cancel()
+        elif source.exception() is not None:
+            waiter.set_exception(source.exception())
+        else:
+            waiter.set_result(source.result())
+
+    future.add_done_callback(lambda source: loop.call_soon_threadsafe(copy, source))
+    return await waiter
+
+
+async def cached_calorie(image_data, detected_objects, timer, tier=None, forced=False):
+    # Identical uploads at the same tier are answered from the result cache, or wait for the
+    # request already computing them
+    if calorie_result_cache is None:
+        frame = await decode(image_data, timer)
+        return await run_on_worker(calorie_estimation, frame, detected_objects, timer=timer, tier=tier,
+                                   forced=forced)
+
+    key = calorie_cache_key(image_data, detected_objects, tier, forced)
+    future, owner = calorie_result_cache.claim(key)
+    if owner:
+        task = asyncio.ensure_future(fill_calorie_cache(key, future, image_data, detected_objects, timer, tier,
+                                                         forced))
+        cache_fills.add(task)
+        task.add_done_callback(cache_fills.discard)
+    return await wait_shared(future)
+
+
+async def upload_file(request):
+    form = await request.form()
+    if 'image' not in form:
+        return PlainTextResponse('Missing image', status_code=400)
+    forced = requested_tier(request, form)
+    if forced is not None and forced not in QUALITY_TIERS:
+        return unknown_tier_response()
+    image_data = await form['image'].read()
+
+    # Decode, then hand the model call to a device worker. The SAM prefetch runs at the tier the
+    # load calls for, which the following /calorie most likely gets.
+    timer = StageTimer()
+    frame = await decode(image_data, timer)
+    try:
+        with tier_selector.request(forced) as tier, timer.stage('inference'):
+            result = await run_on_worker(yolo_detection, frame, tier=tier, forced=forced is not None)
+    except QueueFull as e:
+        return queue_full_response(e)
+    return timed_response(result, timer, tier)
+
+
+async def calorie(request):
+    form = await request.form()
+    if 'image' not in form or 'data' not in form:
+        return PlainTextResponse('Missing image or data', status_code=400)
+    forced = requested_tier(request, form)
+    if forced is not None and forced not in QUALITY_TIERS:
+        return unknown_tier_response()
+    image_data = await form['image'].read()
+    detected_objects = json.loads(await form['data'].read())
+
+    timer = StageTimer()
+    try:
+        with tier_selector.request(forced, timer) as tier:
+            result = await cached_calorie(image_data, detected_objects, timer, tier, forced is not None)
+    except QueueFull as e:
+        return queue_full_response(e)
+    return timed_response(result, timer, tier)
+
+
+async def analyze(request):
+    form = await request.form()
+    if 'image' not in form:
+        return PlainTextResponse('Missing image', status_code=400)
+    forced = requested_tier(request, form)
+    if forced is not None and forced not in QUALITY_TIERS:
+        return unknown_tier_response()
+    image_data = await form['image'].read()
+
+    timer = StageTimer()
+    frame = await decode(image_data, timer)
+    try:
+        with tier_selector.request(forced, timer) as tier:
+            result = await run_on_worker(analyze_image, frame, timer=timer, tier=tier, forced=forced is not None)
+    except QueueFull as e:
+        return queue_full_response(e)
+    return timed_response(result, timer, tier)
+
+
+async def stats(request):
+    stats = server_stats()
+    stats['workers'] = worker_pool.stats()
+    return NumpyJSONResponse(stats)
+
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+app = Starlette(routes=[
+    Route('/yolo', upload_file, methods=['POST']),
+    Route('/calorie', calorie, methods=['POST']),
+    Route('/analyze', analyze, methods=['POST']),
+    Route('/stats', stats, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+])
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=8081)
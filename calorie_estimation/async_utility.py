@@ -1,12 +1,12 @@
 import torch
 import cv2
 import numpy as np
-import joblib
-import pandas as pd
 import json
-import io
-from PIL import Image
+import hashlib
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -16,30 +16,90 @@ import sys
 import os
 
 sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
-from depth_to_pointcloud import depth_estimation, process_images  # Ensure this is correctly imported
-
-from segment_anything import sam_model_registry, SamPredictor
+from depth_to_pointcloud import process_image_tensor, DepthBatcher, \
+    CompiledForward, compile_depth_model, OnnxDepthModel, DEPTH_FLIP_AUG, DEPTH_ROI, DEPTH_ROI_MARGIN, roi_mask  # Ensure this is correctly imported
+
+from model_registry import model_registry
+from caching import LRUTTLCache, ResultCache
+from mass_predictor import FEATURE_NAMES, MassPredictor
+from segmentation import predict_box_masks, sam_predictor
+from geometry import build_segmentation, regression_features, depth_roi_boxes
+from timing import StageTimer
+from device_workers import CPUWorkerProcess
+from image_frame import ImageFrame
+from metrics import metrics, instrument
+from precision import MODEL_PRECISION, precision_dtype, protect_fp32_modules
+from quality_tiers import QUALITY_TIERS, BEST_TIER, tier_selector, autocast_dtype, uses_reduced_precision
 
 # Constants
-CHECKPOINT_PATH = "./data/models/sam_vit_h_4b8939.pth"
-MODEL_TYPE = "vit_h"
 REAL_COIN_AREA = 13 ** 2 * np.pi
+DEPTH_TO_CM = 100  # The volume stage works in centimeters, the depth stage scales on the device
+
+# SAM image embedding cache, shared between /yolo and /calorie for the same photo
+SAM_CACHE_MAX_ENTRIES = int(os.environ.get('SAM_CACHE_MAX_ENTRIES', 32))
+SAM_CACHE_TTL = float(os.environ.get('SAM_CACHE_TTL', 600))  # Seconds
+SAM_CACHE_MAX_BYTES = int(os.environ.get('SAM_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+SAM_CACHE_ON_HOST = os.environ.get('SAM_CACHE_ON_HOST', '0') == '1'  # Keep features in host RAM instead of GPU memory
+SAM_PREFETCH_ON_YOLO = os.environ.get('SAM_PREFETCH_ON_YOLO', '1') == '1'  # Encode the image for SAM during /yolo
+
+# Dynamic micro-batching of ZoeDepth forwards across concurrent requests, 1 disables batching
+DEPTH_BATCH_MAX_SIZE = int(os.environ.get('DEPTH_BATCH_MAX_SIZE', 4))
+DEPTH_BATCH_MAX_WAIT_MS = float(os.environ.get('DEPTH_BATCH_MAX_WAIT_MS', 5))
+
+# torch.compile the ZoeDepth forward at startup, falling back to eager if compilation fails.
+# The mode is passed to torch.compile, e.g. 'reduce-overhead' or 'max-autotune'.
+DEPTH_COMPILE = os.environ.get('DEPTH_COMPILE', '0') == '1'
+DEPTH_COMPILE_MODE = os.environ.get('DEPTH_COMPILE_MODE') or None
+
+# CPU backend, used when no CUDA device is present
+CPU_THREADS = int(os.environ.get('CPU_THREADS', os.cpu_count() or 1))  # Intra-op threads shared by all CPU workers
+CPU_INTEROP_THREADS = int(os.environ.get('CPU_INTEROP_THREADS', 2))
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', 0))  # Worker processes sharing one set of weights, 0 runs in-process
+
+# Run the SAM encoder and ZoeDepth at the same time, they don't depend on each other
+PARALLEL_STAGES = os.environ.get('PARALLEL_STAGES', '1') == '1'
+# On the CPU the two stages split the intra-op threads of their process, fixed at startup: the
+# thread count is process-wide, so deriving it from get_num_threads() per request would halve it
+# again on every request
+STAGE_THREADS = max(1, CPU_THREADS // max(1, CPU_WORKERS) // 2)
+
+def init_stage_thread():
+    if not torch.cuda.is_available():
+        torch.set_num_threads(STAGE_THREADS)
+
+stage_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('PARALLEL_STAGE_WORKERS', 8)),
+                                    thread_name_prefix='stage', initializer=init_stage_thread)
+
+# /calorie results keyed on the image bytes and detections, so retried uploads are answered
+# from memory and identical requests in flight share one computation. 0 entries disables it.
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1024))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 600))  # Seconds
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 16 * 1024 ** 2))
+
+# Mass regression shared by all requests, rows of concurrent requests are predicted together
+MASS_BATCH_MAX_ROWS = int(os.environ.get('MASS_BATCH_MAX_ROWS', 256))
+MASS_BATCH_MAX_WAIT_MS = float(os.environ.get('MASS_BATCH_MAX_WAIT_MS', 0))
 
 def resize_and_save_image(image_bytes):
-    # Open the image from bytes
-    with io.BytesIO(image_bytes) as img_buffer:
-        with Image.open(img_buffer) as img:
-            img = img.resize((640, 640), 1)
-            output_buffer = io.BytesIO()
-            img.save(output_buffer, format='PNG')
-            modified_image_bytes = output_buffer.getvalue()
-    return modified_image_bytes
+    # Only for callers that need encoded bytes, the pipeline itself passes ImageFrame objects
+    return ImageFrame.from_bytes(image_bytes).to_bytes()
 
 class ModelManager:
     def __init__(self):
         self.devices = [torch.device(f'cuda:{i}') for i in range(torch.cuda.device_count())]
         self.models = {}
+        self.cpu_workers = {}
         self.lock = threading.Lock()
+        self.embedding_cache = LRUTTLCache(max_entries=SAM_CACHE_MAX_ENTRIES, ttl=SAM_CACHE_TTL,
+                                           max_bytes=SAM_CACHE_MAX_BYTES, sizeof=embedding_nbytes)
+        self.mass_predictor = None
+        self.depth_compile = {}
+
+        if not self.devices:
+            self.init_cpu_backend()
+            return
+
+        self.mass_predictor = self.create_mass_predictor()
 
         # Load models on each device
         for device in self.devices:
@@ -47,37 +107,99 @@ class ModelManager:
                 'sam_model': self.load_sam_model(device),
                 'depth_model': self.load_depth_model(device),
                 'yolo_model': self.load_yolo_model(device),
-                'regression_model': self.load_regression_model()
+                'regression_model': self.load_regression_model(),
+                'mass_predictor': self.mass_predictor
             }
+            self.models[device]['depth_batcher'] = self.create_depth_batcher(self.models[device]['depth_model'], device)
+
+    def init_cpu_backend(self):
+        # Load one model set and size the torch thread pools to the cores
+        device = torch.device('cpu')
+        torch.set_num_threads(CPU_THREADS)
+        try:
+            torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+        except RuntimeError:
+            pass  # Can only be set before inter-op parallel work has started
+
+        models = {
+            'sam_model': self.load_sam_model(device),
+            'depth_model': self.load_depth_model(device),
+            'yolo_model': self.load_yolo_model(device),
+            'regression_model': self.load_regression_model(),
+            'mass_predictor': None,
+            'depth_batcher': None
+        }
+        if CPU_WORKERS <= 0:
+            self.devices = [device]
+            self.models[device] = models
+            self.mass_predictor = models['mass_predictor'] = self.create_mass_predictor()
+            models['depth_batcher'] = self.create_depth_batcher(models['depth_model'], device)
+            return
+
+        # Fork worker processes before any inference threads exist, they share the weights read-only.
+        # Each worker calls the regression model directly, the batching thread would not survive the fork.
+        for module in (models['sam_model'], models['depth_model'], models['yolo_model']):
+            module.share_memory()
+        estimator_factory = lambda: CalorieEstimator(models, device, self.embedding_cache)
+        threads_per_worker = max(1, CPU_THREADS // CPU_WORKERS)
+        for i in range(CPU_WORKERS):
+            slot = torch.device('cpu', i)
+            self.devices.append(slot)
+            self.models[slot] = models
+            self.cpu_workers[slot] = CPUWorkerProcess(f'cpu-worker-{i}', estimator_factory, threads_per_worker)
+
+    def run(self, device, method, *args, **kwargs):
+        # Runs a CalorieEstimator method on the device, or in the worker process behind a CPU slot
+        if device in self.cpu_workers:
+            return self.cpu_workers[device].call(method, *args, **kwargs)
+        estimator = CalorieEstimator(self.models[device], device, self.embedding_cache)
+        return getattr(estimator, method)(*args, **kwargs)
 
     def load_sam_model(self, device):
-        # Load SAM model
-        sam_model = sam_model_registry[MODEL_TYPE](checkpoint=CHECKPOINT_PATH).to(device=device)
-        return sam_model
+        return model_registry.get('sam_model', device)
 
     def load_depth_model(self, device):
-        # Load depth estimation model
-        from zoedepth.models.builder import build_model
-        from zoedepth.utils.config import get_config
-        model_name = 'zoedepth'
-        DATASET = 'nyu'  # Replace with your dataset name
-        config = get_config(model_name, 'eval', DATASET)
-        pretrained_resource = 'local::data/models/Depth-Anything/metric_depth/checkpoints/nutrition5k_03-May_12-04-b56f6cfdfe15_latest.pt'
-        config.pretrained_resource = pretrained_resource
-        depth_model = build_model(config).to(device)
-        depth_model.eval()
+        depth_model = model_registry.get('depth_model', device)
+        if uses_reduced_precision():
+            # Quality tiers run ZoeDepth under autocast, its bin and attractor layers stay in fp32
+            protect_fp32_modules('depth_model', depth_model, device)
+        if DEPTH_COMPILE and not isinstance(depth_model, OnnxDepthModel) and \
+                not isinstance(depth_model.forward, CompiledForward):
+            if torch.device(device).type == 'cpu' and CPU_WORKERS > 0:
+                # Compiled code and the compiler's worker pool don't survive forking the CPU workers
+                print('DEPTH_COMPILE is ignored with CPU_WORKERS > 0')
+            else:
+                # Warm up every batch size the depth batcher can form, doubled by the flip augmentation
+                batch_sizes = [n * (2 if DEPTH_FLIP_AUG else 1) for n in range(1, max(1, DEPTH_BATCH_MAX_SIZE) + 1)]
+                # and every depth input size and autocast dtype of the quality tiers
+                variants = list(dict.fromkeys((QUALITY_TIERS[tier]['depth_size'], autocast_dtype(tier))
+                                              for tier in QUALITY_TIERS))
+                self.depth_compile[str(device)] = compile_depth_model(depth_model, device, DEPTH_COMPILE_MODE,
+                                                                      batch_sizes, variants)
         return depth_model
 
+    def create_depth_batcher(self, depth_model, device):
+        if DEPTH_BATCH_MAX_SIZE <= 1:
+            return None
+        return DepthBatcher(depth_model, device, max_batch_size=DEPTH_BATCH_MAX_SIZE,
+                            max_wait_ms=DEPTH_BATCH_MAX_WAIT_MS)
+
     def load_regression_model(self):
-        # Load regression model (assumed to be CPU-based)
-        regression_model = joblib.load('./data/models/regression_model.pkl')
-        return regression_model
+        # Regression model is CPU-based and shared by every device
+        return model_registry.get('regression_model')
 
     def load_yolo_model(self, device):
-        yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path='./data/models/yolo.pt', device=device)
-        return yolo_model
+        return model_registry.get('yolo_model', device)
+
+    def create_mass_predictor(self):
+        return MassPredictor(self.load_regression_model(), max_batch_rows=MASS_BATCH_MAX_ROWS,
+                             max_wait_ms=MASS_BATCH_MAX_WAIT_MS)
 
-    def get_device(self):
+    def get_device(self, frame=None):
+        # Each CPU worker process has its own SAM embedding cache, so requests for the same image
+        # go to the same worker and /calorie finds the embedding /yolo prefetched
+        if frame is not None and self.cpu_workers:
+            return self.devices[int(frame.digest()[:8], 16) % len(self.devices)]
         # Simple device selection logic
         with self.lock:
             # Round-robin selection
@@ -88,19 +210,88 @@ class ModelManager:
     def get_models(self, device):
         return self.models[device]
 
+    def get_stats(self):
+        stats = {'sam_embedding_cache': self.embedding_cache.stats(), 'depth_batcher': {},
+                 'model_load_seconds': model_registry.get_load_times(),
+                 'mass_predictor': self.mass_predictor.stats() if self.mass_predictor is not None else None,
+                 'depth_compile': {device: compiled.stats() for device, compiled in self.depth_compile.items()}}
+        stats['pos_embed_cache'] = {}
+        for device, models in self.models.items():
+            for module in models['depth_model'].modules():
+                if hasattr(module, 'pos_embed_cache'):
+                    stats['pos_embed_cache'][str(device)] = module.pos_embed_cache.stats()
+            if models['depth_batcher'] is not None:
+                stats['depth_batcher'][str(device)] = models['depth_batcher'].stats()
+        stats['cpu_worker_restarts'] = {str(device): worker.restarts for device, worker in self.cpu_workers.items()}
+        return stats
+
+    def metric_samples(self):
+        # Queue lengths, cache size and model load times for /metrics
+        cache = self.embedding_cache.stats()
+        batchers = [(device, models['depth_batcher']) for device, models in self.models.items()
+                    if models['depth_batcher'] is not None]
+        samples = [
+            ('calorie_depth_batch_queue_depth', 'Depth requests waiting to join a ZoeDepth batch',
+             [({'device': str(device)}, batcher.queue.qsize()) for device, batcher in batchers]),
+            ('calorie_sam_cache_entries', 'Cached SAM image embeddings', [({}, cache['entries'])]),
+            ('calorie_sam_cache_bytes', 'Memory held by cached SAM image embeddings', [({}, cache['bytes'])]),
+            ('calorie_model_load_seconds', 'Time taken to load each model',
+             [({'model': name}, seconds) for name, seconds in model_registry.get_load_times().items()]),
+        ]
+        if self.mass_predictor is not None:
+            samples.append(('calorie_mass_queue_depth', 'Mass predictions waiting for the regression thread',
+                            [({}, self.mass_predictor.queue.qsize())]))
+        return samples
+
+def result_nbytes(result):
+    return len(json.dumps(result, default=float))
+
+def calorie_cache_key(image_bytes, detected_objects, tier=None, forced=False):
+    # Content hash of the upload plus the detections in canonical form, so key order and
+    # whitespace in the forwarded JSON don't matter. Results of different quality tiers differ, and
+    # a forced tier's from the tier's own when the automatic one decoded a larger cached embedding.
+    digest = hashlib.sha256(image_bytes)
+    digest.update(json.dumps(detected_objects, sort_keys=True, separators=(',', ':'), default=float).encode())
+    if tier is not None:
+        digest.update(tier.encode())
+    if forced:
+        digest.update(b'forced')
+    return digest.hexdigest()
+
+def embedding_nbytes(embedding):
+    features = embedding['features']
+    return features.numel() * features.element_size()
+
 class CalorieEstimator:
-    def __init__(self, models, device):
+    def __init__(self, models, device, embedding_cache=None):
         self.device = device
         self.sam_model = models['sam_model']
-        self.mask_predictor = SamPredictor(self.sam_model)
+        self.embedding_cache = embedding_cache
         self.depth_model = models['depth_model']
+        self.depth_batcher = models.get('depth_batcher')
         self.yolo_model = models['yolo_model']
         self.regression_model = models['regression_model']
-
-    def yolo_object_detection(self, image_bytes):
+        self.mass_predictor = models.get('mass_predictor') or self.regression_model
+        self.use_tier(BEST_TIER)
+
+    def use_tier(self, tier, forced=False):
+        # SAM encoder resolution, depth input size and autocast of a quality tier. forced is set
+        # when the client asked for the tier, which then runs exactly at its own settings
+        self.tier = tier
+        self.tier_forced = forced
+        settings = QUALITY_TIERS[tier]
+        self.mask_predictor = sam_predictor(self.sam_model, settings['sam_size'])
+        self.depth_size = settings['depth_size']
+        self.autocast_dtype = autocast_dtype(tier)
+        # The scaled SAM predictor calls the encoder's parts directly, past the SAM_PRECISION wrapper
+        configured = precision_dtype(MODEL_PRECISION['sam_model'])
+        self.sam_autocast_dtype = self.autocast_dtype or (configured if configured != torch.float32 else None)
+
+    def yolo_object_detection(self, frame, prefetch=SAM_PREFETCH_ON_YOLO, tier=None, forced=False):
+        if tier is not None:
+            self.use_tier(tier, forced)
         self.yolo_model.eval()
-        image = Image.open(io.BytesIO(image_bytes))
-        results = self.yolo_model(image)
+        results = self.yolo_model(frame.array)
         detected_objects = []
 
         # Convert predictions into padnas dataframe
@@ -117,126 +308,231 @@ class CalorieEstimator:
                 'bbox': [int(row['xmin']), int(row['ymin']), int(row['xmax']), int(row['ymax'])]
             }
             detected_objects.append(detected_object)
-            
-        return detected_objects
 
-    def perform_segmentation(self, image_bytes, bounding_boxes, real_coin_area=REAL_COIN_AREA):
-        # Load and prepare the image
-        image = Image.open(io.BytesIO(image_bytes))
-        image_np = np.array(image)
-        image_rgb = cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB)
-        self.mask_predictor.set_image(image_rgb)
-
-        details = {}
-        coin_image_area = None
-        confidence = 0
-
-        for obj in bounding_boxes:
-            bbox = np.array(obj['bbox'])
-            masks, scores, _ = self.mask_predictor.predict(box=bbox, multimask_output=False)
-            area = np.count_nonzero(masks[0])
-            details[obj['name']] = {'mask': masks[0], 'image_area': area, 'object_id': obj['class']}
-            if obj['name'] == 'coin' and float(obj['confidence']) > confidence:
-                coin_image_area = area
-                confidence = float(obj['confidence'])
-
-        if coin_image_area:
-            scale_factor = real_coin_area / coin_image_area
-            for key, value in details.items():
-                if key != 'coin':
-                    image_area = value['image_area']
-                    real_area = scale_factor * image_area
-                    value['real_life_area'] = real_area
-                value['scale_factor'] = scale_factor
-
-        return details
-
-    def calculate_volume_and_mass(self, segmentation_details, depth_map):
-        depth_map = np.array(depth_map)
-        depth_map *= 100  # Convert to centimeters
+        if prefetch and self.embedding_cache is not None:
+            # /calorie follows on the same photo, so run the SAM encoder now, at the tier the load
+            # calls for now
+            self.set_sam_image(frame)
 
-        results = []
-        regression_input = {'object_id': [], 'area': [], 'volume': []}
-        names = []
-        cam_plane_to_coin = None
-        coin_to_plate = 25  # Adjust this value as needed
-
-        coin_details = segmentation_details.get('coin')
-        if coin_details:
-            coin_mask = coin_details['mask']
-            coin_x_centroid, coin_y_centroid = self.coin_centroid(coin_mask)
-            if coin_x_centroid is not None and coin_y_centroid is not None:
-                cam_plane_to_coin = depth_map[coin_x_centroid, coin_y_centroid]
-
-        for key, details in segmentation_details.items():
-            if key == 'coin':
-                continue
-
-            names.append(key)
-            mask = details['mask']
-            area = details['real_life_area']
-            object_id = details['object_id']
-            regression_input['object_id'].append(object_id)
-            regression_input['area'].append(area)
-
-            masked_depth_map = np.where(mask, depth_map, 0)
-            non_zero_depths = masked_depth_map[masked_depth_map != 0]
-
-            if non_zero_depths.size > 0 and cam_plane_to_coin is not None:
-                food_depths = np.maximum(0, cam_plane_to_coin - non_zero_depths)
-                food_depths = np.maximum(0, food_depths - coin_to_plate)
-                volume = np.sum(food_depths) * details['scale_factor']
-                regression_input['volume'].append(volume)
-            else:
-                regression_input['volume'].append(0)
+        return detected_objects
 
-        regression_input_df = pd.DataFrame.from_dict(regression_input)
-        pred = self.regression_model.predict(regression_input_df)
+    def set_sam_image(self, frame):
+        # Run the SAM image encoder, reusing cached features for an image we have already seen
+        # Features differ with the encoder resolution of the tier
+        key = (frame.digest(), self.mask_predictor.transform.target_length) if self.embedding_cache is not None else None
+        embedding = self.cached_sam_embedding(frame) if key is not None else None
+        if embedding is not None:
+            self.mask_predictor.reset_image()
+            self.mask_predictor.features = embedding['features'].to(self.device)
+            self.mask_predictor.original_size = embedding['original_size']
+            self.mask_predictor.input_size = embedding['input_size']
+            self.mask_predictor.is_image_set = True
+            return
+
+        image_rgb = cv2.cvtColor(frame.array, cv2.COLOR_BGR2RGB)
+        with torch.autocast(torch.device(self.device).type, dtype=self.sam_autocast_dtype) \
+                if self.sam_autocast_dtype is not None else nullcontext():
+            self.mask_predictor.set_image(image_rgb)
+        # The mask decoder runs in the model's own precision
+        self.mask_predictor.features = self.mask_predictor.features.float()
+
+        if key is not None:
+            features = self.mask_predictor.features
+            self.embedding_cache.put(key, {
+                'features': features.cpu() if SAM_CACHE_ON_HOST else features,
+                'original_size': self.mask_predictor.original_size,
+                'input_size': self.mask_predictor.input_size,
+            })
+
+    def cached_sam_embedding(self, frame):
+        # Cached features at the tier's encoder size, or else at a larger tier's. The /yolo prefetch
+        # may have run at a different tier than this request, and decoding masks from those
+        # features is much cheaper than encoding again, most of all when load changed the tier.
+        # Smaller features would lower the quality below the tier's, and a forced tier gets only
+        # its own.
+        own = self.mask_predictor.transform.target_length
+        native = self.sam_model.image_encoder.img_size
+        sizes = [] if self.tier_forced else \
+            sorted({min(tier['sam_size'] or native, native) for tier in QUALITY_TIERS.values()
+                    if min(tier['sam_size'] or native, native) > own}, reverse=True)
+        for size in [own] + sizes:
+            embedding = self.embedding_cache.get((frame.digest(), size))
+            if embedding is not None:
+                if size != own:
+                    self.mask_predictor = sam_predictor(self.sam_model, size)
+                return embedding
+        return None
+
+    def perform_segmentation(self, frame, bounding_boxes, real_coin_area=REAL_COIN_AREA):
+        # Prepare the image, unless the encoder already ran for this request
+        if not self.mask_predictor.is_image_set:
+            self.set_sam_image(frame)
+
+        # Area, volume and depth (with DEPTH_ROI) all cover each box grown by DEPTH_ROI_MARGIN
+        masks, areas = predict_box_masks(self.mask_predictor, [obj['bbox'] for obj in bounding_boxes],
+                                         DEPTH_ROI_MARGIN)
+        return build_segmentation(bounding_boxes, masks, areas, real_coin_area, DEPTH_ROI_MARGIN)
+
+    def calculate_volume_and_mass(self, segmentation, depth_map):
+        # depth_map is the float32 map in centimeters from depth_estimation
+        foods, regression_input = regression_features(segmentation, depth_map)
+        if not foods:
+            return []
+
+        regression_input = np.column_stack([regression_input[name] for name in FEATURE_NAMES])
+        pred = self.mass_predictor.predict(regression_input)
 
-        for name, mass in zip(names, pred):
-            results.append({'name': name, 'mass': mass})
+        results = []
+        for food, mass in zip(foods, pred):
+            results.append({'instance_id': food['instance_id'], 'name': food['name'], 'mass': mass})
 
         return results
 
-    def coin_centroid(self, mask):
-        indices = np.argwhere(mask > 0)
-        if indices.size == 0:
-            return None, None
-        y_centroid, x_centroid = np.mean(indices, axis=0)
-        return int(x_centroid), int(y_centroid)
+    def depth_estimation(self, frame, detected_objects=None):
+        # Implement depth estimation using the preloaded depth_model. The batcher moves inputs to
+        # the device on its own thread and stream, so it takes the host tensor.
+        image_tensor = frame.tensor('cpu' if self.depth_batcher is not None else self.device)
+        # With DEPTH_ROI, depth is only computed where the volume computation reads it
+        roi = roi_mask(depth_roi_boxes(detected_objects)) \
+            if DEPTH_ROI and detected_objects is not None else None
+        depth_map = process_image_tensor(self.depth_model, image_tensor, self.device, self.depth_batcher, roi,
+                                         scale=DEPTH_TO_CM, img_size=self.depth_size,
+                                         autocast_dtype=self.autocast_dtype)
+        return depth_map
 
-    def depth_estimation(self, image_bytes):
-        # Implement depth estimation using the preloaded depth_model
-        depth_map = process_images(self.depth_model, image_bytes, self.device)
+    def run_stage(self, fn, frame):
+        # Runs one stage on its own CUDA stream, or on a stage thread with its share of intra-op
+        # threads on CPU
+        started = time.perf_counter()
+        if torch.device(self.device).type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+            with torch.cuda.device(self.device), torch.cuda.stream(stream):
+                result = fn(frame)
+            stream.synchronize()
+        else:
+            result = fn(frame)
+        return result, started, time.perf_counter()
+
+    def encode_and_estimate_depth(self, frame, timer, detected_objects=None):
+        if not PARALLEL_STAGES:
+            with timer.stage('sam_encode'):
+                self.set_sam_image(frame)
+            with timer.stage('depth'):
+                return self.depth_estimation(frame, detected_objects)
+
+        started = time.perf_counter()
+        sam_future = stage_executor.submit(self.run_stage, self.set_sam_image, frame)
+        depth_future = stage_executor.submit(self.run_stage, lambda frame: self.depth_estimation(frame, detected_objects),
+                                             frame)
+        _, sam_start, sam_end = sam_future.result()
+        depth_map, depth_start, depth_end = depth_future.result()
+        finished = time.perf_counter()
+
+        # Overlap is the time both stages were running, the wall-clock gain over running them in turn
+        timer.timings['sam_encode'] = 1000 * (sam_end - sam_start)
+        timer.timings['depth'] = 1000 * (depth_end - depth_start)
+        timer.timings['sam_encode_depth_wall'] = 1000 * (finished - started)
+        timer.timings['sam_encode_depth_overlap'] = 1000 * max(0, min(sam_end, depth_end) - max(sam_start, depth_start))
         return depth_map
 
-    def calorie_estimation(self, image_bytes, detected_objects):
-        image_bytes = resize_and_save_image(image_bytes)
-        segmentation_details = self.perform_segmentation(image_bytes, detected_objects)
-        depth_maps = self.depth_estimation(image_bytes)
-        results = self.calculate_volume_and_mass(segmentation_details, depth_maps)
+    def calorie_estimation(self, frame, detected_objects, timer=None, tier=None, forced=False):
+        if timer is None:
+            timer = StageTimer(self.device)
+        if tier is not None:
+            self.use_tier(tier, forced)
+        depth_maps = self.encode_and_estimate_depth(frame, timer, detected_objects)
+        with timer.stage('sam_decode'):
+            segmentation_details = self.perform_segmentation(frame, detected_objects)
+        with timer.stage('volume_and_mass'):
+            results = self.calculate_volume_and_mass(segmentation_details, depth_maps)
         torch.cuda.empty_cache()
         return results
 
+    def analyze(self, frame, timer, tier=None, forced=False):
+        # Detection, segmentation and depth in one pass over the same decoded image
+        if tier is not None:
+            self.use_tier(tier, forced)
+        with timer.stage('yolo'):
+            detected_objects = self.yolo_object_detection(frame, prefetch=False)
+        depth_map = self.encode_and_estimate_depth(frame, timer, detected_objects)
+        with timer.stage('sam_decode'):
+            segmentation_details = self.perform_segmentation(frame, detected_objects)
+        with timer.stage('volume_and_mass'):
+            results = self.calculate_volume_and_mass(segmentation_details, depth_map)
+        return detected_objects, results
+
+# Record every pipeline stage in the /metrics histograms
+PIPELINE_STAGES = {
+    'yolo_object_detection': 'yolo',
+    'set_sam_image': 'sam_encode',
+    'perform_segmentation': 'sam_decode',
+    'depth_estimation': 'depth',
+    'calculate_volume_and_mass': 'regression',
+}
+instrument(CalorieEstimator, PIPELINE_STAGES)
+
 # Initialize ModelManager
 model_manager = ModelManager()
+metrics.add_collector(model_manager.metric_samples)
+metrics.add_collector(tier_selector.metric_samples)
+
+calorie_result_cache = ResultCache(max_entries=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL,
+                                   max_bytes=RESULT_CACHE_MAX_BYTES, sizeof=result_nbytes) \
+    if RESULT_CACHE_MAX_ENTRIES > 0 else None
 
-def calorie_estimation(image_bytes, detected_objects):
+def result_cache_samples():
+    if calorie_result_cache is None:
+        return []
+    stats = calorie_result_cache.stats()
+    return [(f'calorie_result_cache_{name}', f'/calorie result cache {name.replace("_", " ")}', [({}, stats[name])])
+            for name in ('hits', 'misses', 'coalesced', 'in_flight', 'entries', 'bytes')]
+
+metrics.add_collector(result_cache_samples)
+
+def calorie_estimation(frame, detected_objects, device=None, timer=None, tier=None, forced=False):
     # Get device and models
-    device = model_manager.get_device()
-    models = model_manager.get_models(device)
-    
-    estimator = CalorieEstimator(models, device)
-    result = estimator.calorie_estimation(image_bytes, detected_objects)
+    if device is None:
+        device = model_manager.get_device(frame)
+    if timer is None:
+        timer = StageTimer()
+    timer.device = device
+    result = model_manager.run(device, 'calorie_estimation', frame, detected_objects, timer=timer, tier=tier,
+                               forced=forced)
     #torch.cuda.empty_cache()
     return result
 
-def yolo_detection(image_bytes):
+def yolo_detection(frame, device=None, tier=None, forced=False):
     # Get device and models
-    device = model_manager.get_device()
-    models = model_manager.get_models(device)
-    
-    estimator = CalorieEstimator(models, device)
-    result = estimator.yolo_object_detection(image_bytes)
+    if device is None:
+        device = model_manager.get_device(frame)
+    result = model_manager.run(device, 'yolo_object_detection', frame, tier=tier, forced=forced)
     #torch.cuda.empty_cache()
-    return result
\ No newline at end of file
+    return result
+
+def analyze_image(frame, device=None, timer=None, tier=None, forced=False):
+    # Get device and models
+    if device is None:
+        device = model_manager.get_device(frame)
+    if timer is None:
+        timer = StageTimer()
+    timer.device = device
+
+    detected_objects, results = model_manager.run(device, 'analyze', frame, timer=timer, tier=tier, forced=forced)
+    return {'detected_objects': detected_objects, 'results': results, 'timings_ms': timer.timings,
+            'quality_tier': tier or BEST_TIER}
+
+def cached_calorie_estimation(image_bytes, detected_objects, decode, timer=None, tier=None, forced=False):
+    # calorie_estimation on the frame decode(image_bytes) returns, answered from the result cache
+    # when the same upload was seen before at the same tier or is being computed right now
+    def compute():
+        return calorie_estimation(decode(image_bytes), detected_objects, timer=timer, tier=tier, forced=forced)
+    if calorie_result_cache is None:
+        return compute()
+    return calorie_result_cache.get_or_compute(calorie_cache_key(image_bytes, detected_objects, tier, forced),
+                                               compute)
+
+def server_stats():
+    stats = model_manager.get_stats()
+    stats['calorie_result_cache'] = calorie_result_cache.stats() if calorie_result_cache is not None else None
+    stats['quality_tiers'] = tier_selector.stats()
+    return stats
@@ -0,0 +1,74 @@
+# Throughput benchmark for the CPU backend of ModelManager. Every request gets a distinct image and
+# the SAM embedding cache is off, so each one runs the full ViT-H encode.
+# Run from the calorie_estimation directory so model paths resolve, e.g.
+#   CUDA_VISIBLE_DEVICES= CPU_WORKERS=4 python benchmarks/cpu_throughput.py --requests 64 --concurrency 4
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# A repeated image would be a cached embedding instead of an encode
+os.environ['SAM_CACHE_MAX_ENTRIES'] = '0'
+
+
+def load_images(image_dir, count):
+    from image_frame import ImageFrame
+    if image_dir is None:
+        # Random noise still exercises every stage at full resolution
+        rng = np.random.default_rng(0)
+        return [ImageFrame(rng.integers(0, 256, (640, 640, 3), dtype=np.uint8)) for _ in range(count)]
+    paths = sorted(glob.glob(os.path.join(image_dir, '*')))
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(ImageFrame.from_bytes(f.read()))
+    return images
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU backend throughput benchmark')
+    parser.add_argument('--images', type=str, default=None, help='Directory of food photos, random images if omitted')
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2)
+    args = parser.parse_args()
+
+    from async_utility import analyze_image, model_manager
+    print(f'devices: {[str(d) for d in model_manager.devices]}')
+    images = load_images(args.images, args.warmup + args.requests)
+
+    for i in range(args.warmup):
+        analyze_image(images[i % len(images)])
+
+    latencies = []
+
+    def request(i):
+        started = time.perf_counter()
+        analyze_image(images[(args.warmup + i) % len(images)])
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(request, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = [1000 * latency for latency in latencies]
+    print(f'requests: {args.requests}  concurrency: {args.concurrency}')
+    print(f'throughput: {args.requests / elapsed:.2f} req/s')
+    print(f'latency ms  p50: {percentile(latencies_ms, 50):.1f}  p95: {percentile(latencies_ms, 95):.1f}  '
+          f'p99: {percentile(latencies_ms, 99):.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Throughput of the depth model on the PyTorch and ONNX Runtime backends at 640x640.
+# Export the graph first with tools/export_depth_onnx.py, then from calorie_estimation:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/depth_backends.py --requests 32 --concurrency 2 --sessions 2
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+
+def run(name, model, requests, concurrency, warmup):
+    from depth_to_pointcloud import DATASET, FINAL_HEIGHT, FINAL_WIDTH
+    image = torch.rand(1, 3, FINAL_HEIGHT, FINAL_WIDTH)
+    latencies = []
+
+    def request(_):
+        started = time.perf_counter()
+        with torch.no_grad():
+            model(image, dataset=DATASET)
+        latencies.append(1000 * (time.perf_counter() - started))
+
+    for i in range(warmup):
+        request(i)
+    latencies.clear()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(request, range(requests)))
+    elapsed = time.perf_counter() - started
+    print(f'{name:6s} throughput: {requests / elapsed:6.2f} req/s  p50: {np.percentile(latencies, 50):8.1f} ms  '
+          f'p95: {np.percentile(latencies, 95):8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Depth model throughput, PyTorch vs ONNX Runtime')
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads shared by each backend')
+    parser.add_argument('--sessions', type=int, default=2, help='ONNX Runtime sessions in the pool')
+    parser.add_argument('--onnx', type=str, default=None, help='Exported graph, DEPTH_ONNX_PATH by default')
+    args = parser.parse_args()
+
+    from depth_to_pointcloud import ONNX_MODEL_PATH, OnnxDepthModel, load_depth_model
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    threads = torch.get_num_threads()
+    print(f'threads: {threads}  concurrency: {args.concurrency}  sessions: {args.sessions}')
+
+    run('torch', load_depth_model('cpu'), args.requests, args.concurrency, args.warmup)
+    onnx_model = OnnxDepthModel(args.onnx or ONNX_MODEL_PATH, sessions=args.sessions,
+                                threads=max(1, threads // args.sessions))
+    run('onnx', onnx_model, args.requests, args.concurrency, args.warmup)
+
+
+if __name__ == '__main__':
+    main()
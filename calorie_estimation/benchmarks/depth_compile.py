@@ -0,0 +1,70 @@
+# Steady-state latency of the ZoeDepth forward at 640x640, eager against torch.compile.
+# Run from the calorie_estimation directory, on the CPU by default:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/depth_compile.py --iterations 20 --threads 8
+# With CALORIE_STUB_MODELS=1 the small stand-in model is measured instead.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+
+def measure(model, images, iterations, warmup):
+    from depth_to_pointcloud import DATASET
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            started = time.perf_counter()
+            model(images, dataset=DATASET)
+            if images.is_cuda:
+                torch.cuda.synchronize(images.device)
+            if i >= warmup:
+                latencies.append(1000 * (time.perf_counter() - started))
+    return latencies
+
+
+def report(name, latencies):
+    print(f'{name:8s} p50: {np.percentile(latencies, 50):8.1f} ms  p95: {np.percentile(latencies, 95):8.1f} ms  '
+          f'mean: {np.mean(latencies):8.1f} ms')
+    return float(np.percentile(latencies, 50))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Eager vs compiled ZoeDepth forward latency')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads on the CPU')
+    parser.add_argument('--mode', type=str, default=None, help='torch.compile mode, e.g. max-autotune')
+    args = parser.parse_args()
+
+    from depth_to_pointcloud import FINAL_HEIGHT, FINAL_WIDTH, compile_depth_model
+    from model_registry import model_registry
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = model_registry.get('depth_model', device)
+    images = torch.rand(args.batch_size, 3, FINAL_HEIGHT, FINAL_WIDTH, device=device)
+    print(f'device: {device}  threads: {torch.get_num_threads()}  batch size: {args.batch_size}')
+
+    eager = report('eager', measure(model, images, args.iterations, args.warmup))
+
+    compiled = compile_depth_model(model, device, args.mode, batch_sizes=(args.batch_size,))
+    print(f'compile + warm-up: {compiled.warmup_seconds:.1f}s')
+    if compiled.error is not None:
+        print(f'compilation failed, the server would run eager: {compiled.error}')
+        return
+    steady = report('compiled', measure(model, images, args.iterations, args.warmup))
+    print(f'speedup: {eager / steady:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
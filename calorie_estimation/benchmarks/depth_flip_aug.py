@@ -0,0 +1,69 @@
+# Cost of ZoeDepth's horizontal flip augmentation at 640x640: a single pass without it, the image
+# and its mirror as two sequential forwards, and both stacked into one forward of twice the batch.
+# Also reports how far the batched result is from the sequential one. Run from the
+# calorie_estimation directory:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/depth_flip_aug.py --iterations 10 --threads 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+MODES = {
+    'single': {'with_flip_aug': False},
+    'flip-sequential': {'with_flip_aug': True, 'batch_flip': False},
+    'flip-batched': {'with_flip_aug': True, 'batch_flip': True},
+}
+
+
+def measure(model, images, options, iterations, warmup):
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            started = time.perf_counter()
+            out = model.infer(images, pad_input=False, **options)
+            if images.is_cuda:
+                torch.cuda.synchronize(images.device)
+            if i >= warmup:
+                latencies.append(1000 * (time.perf_counter() - started))
+    return latencies, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZoeDepth flip augmentation: sequential vs batched')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads on the CPU')
+    args = parser.parse_args()
+
+    from depth_to_pointcloud import FINAL_HEIGHT, FINAL_WIDTH
+    from model_registry import model_registry
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = model_registry.get('depth_model', device)
+    if not hasattr(model, 'infer'):
+        print(f'{type(model).__name__} has no DepthModel.infer, run with the PyTorch backend')
+        return
+    images = torch.rand(args.batch_size, 3, FINAL_HEIGHT, FINAL_WIDTH, device=device)
+    print(f'device: {device}  threads: {torch.get_num_threads()}  batch size: {args.batch_size}')
+
+    outputs = {}
+    for name, options in MODES.items():
+        latencies, outputs[name] = measure(model, images, options, args.iterations, args.warmup)
+        print(f'{name:16s} p50: {np.percentile(latencies, 50):8.1f} ms  mean: {np.mean(latencies):8.1f} ms')
+    error = (outputs['flip-batched'] - outputs['flip-sequential']).abs().max().item()
+    print(f'max abs difference batched vs sequential: {error:.2e} m')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Latency of ZoeDepth on a 640x640 plate with metric depth computed over the whole output grid
+# against only inside the detected boxes (DEPTH_ROI=1), and the largest depth difference inside
+# the boxes, which should be at float rounding level. Run from the calorie_estimation directory:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/depth_roi.py --iterations 10 --threads 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+
+def measure(depth, iterations, warmup):
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            started = time.perf_counter()
+            depth_map = np.asarray(depth(), dtype=np.float32)
+            if i >= warmup:
+                latencies.append(1000 * (time.perf_counter() - started))
+    return latencies, depth_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZoeDepth over the full grid vs inside the detected boxes')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads on the CPU')
+    args = parser.parse_args()
+
+    from benchmarks.load_replay import synthesize_payload
+    from depth_to_pointcloud import process_image_tensor, roi_mask, supports_roi
+    from geometry import depth_roi_boxes
+    from image_frame import ImageFrame
+    from model_registry import model_registry
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = model_registry.get('depth_model', device)
+    if not supports_roi(model):
+        print(f'{type(model).__name__} runs without a roi, use the eager PyTorch ZoeDepth without tiling or flip')
+        return
+
+    payload = synthesize_payload(np.random.default_rng(0))
+    image = ImageFrame.from_bytes(payload['image']).tensor(device)
+    roi = roi_mask(depth_roi_boxes(payload['detections']))
+    print(f'device: {device}  threads: {torch.get_num_threads()}  roi: {100 * roi.float().mean().item():.1f}% of the image')
+
+    dense_latencies, dense = measure(lambda: process_image_tensor(model, image, device), args.iterations, args.warmup)
+    roi_latencies, sparse = measure(lambda: process_image_tensor(model, image, device, roi=roi),
+                                    args.iterations, args.warmup)
+    for name, latencies in (('full', dense_latencies), ('roi', roi_latencies)):
+        print(f'{name:5s} p50: {np.percentile(latencies, 50):8.1f} ms  mean: {np.mean(latencies):8.1f} ms')
+    inside = roi.numpy()
+    print(f'max abs difference inside the roi: {np.abs(dense[inside] - sparse[inside]).max():.2e} m')
+
+
+if __name__ == '__main__':
+    main()
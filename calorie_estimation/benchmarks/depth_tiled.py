@@ -0,0 +1,79 @@
+# Latency and peak memory of ZoeDepth on high-resolution photos: the whole image in one forward,
+# which the model resizes to its native resolution, against DepthModel.infer_tiled, which runs
+# overlapping tiles at that resolution a few at a time. Run from the calorie_estimation directory:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/depth_tiled.py --sizes 1280 2560 --threads 8
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+
+def peak_memory_mib(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def measure(infer, images, iterations):
+    latencies = []
+    with torch.no_grad():
+        for _ in range(iterations):
+            started = time.perf_counter()
+            out = infer(images)
+            if images.is_cuda:
+                torch.cuda.synchronize(images.device)
+            latencies.append(1000 * (time.perf_counter() - started))
+    return latencies, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZoeDepth on large images: single forward vs tiles')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1280, 1920], help='Square image sizes in pixels')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--overlap', type=float, default=0.25)
+    parser.add_argument('--tiles-per-batch', type=int, default=4)
+    parser.add_argument('--merge', choices=['feather', 'median'], default='feather')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads on the CPU')
+    args = parser.parse_args()
+
+    from model_registry import model_registry
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = model_registry.get('depth_model', device)
+    if not hasattr(model, 'infer_tiled'):
+        print(f'{type(model).__name__} has no DepthModel.infer_tiled, run with the PyTorch backend')
+        return
+    print(f'device: {device}  threads: {torch.get_num_threads()}  native size: {model.native_size()}')
+
+    modes = {
+        'single': lambda images: model.infer(images, pad_input=False, with_flip_aug=False),
+        'tiled': lambda images: model.infer_tiled(images, overlap=args.overlap, tiles_per_batch=args.tiles_per_batch,
+                                                  merge=args.merge, pad_input=False, with_flip_aug=False),
+    }
+    # Tiled first, the CPU peak (max RSS) only grows, so a larger single forward shows up as an increase
+    for size in args.sizes:
+        images = torch.rand(1, 3, size, size, device=device)
+        outputs = {}
+        for name in ('tiled', 'single'):
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            latencies, outputs[name] = measure(modes[name], images, args.iterations)
+            print(f'{size}x{size} {name:7s} p50: {np.percentile(latencies, 50):8.1f} ms  '
+                  f'peak memory: {peak_memory_mib(device):8.1f} MiB')
+        difference = (outputs['tiled'] - outputs['single']).abs().mean().item()
+        print(f'{size}x{size} mean abs difference tiled vs single: {difference:.3f} m')
+
+
+if __name__ == '__main__':
+    main()
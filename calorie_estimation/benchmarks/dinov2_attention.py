@@ -0,0 +1,92 @@
+# Latency and peak memory of DINOv2 attention with PyTorch's fused scaled_dot_product_attention
+# against the explicit softmax(q @ k^T) @ v used when xFormers is missing, at the ViT-L size
+# and token count of a 640x640 depth request. Also checks that nested-tensor blocks match
+# running every tensor on its own. Run from the calorie_estimation directory:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/dinov2_attention.py --blocks 4
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath('./data/models/Depth-Anything/torchhub/facebookresearch_dinov2_main'))
+
+from dinov2.layers import attention
+from dinov2.layers import MemEffAttention, NestedTensorBlock
+
+# ViT-L/14: 1024 channels, 16 heads; a 640x640 image is 45 x 45 patches plus the class token
+DIM = 1024
+HEADS = 16
+TOKENS = 45 * 45 + 1
+
+
+def peak_memory_mib(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def measure(blocks, x, iterations, warmup):
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            started = time.perf_counter()
+            y = x
+            for block in blocks:
+                y = block(y)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            if i >= warmup:
+                latencies.append(1000 * (time.perf_counter() - started))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DINOv2 attention: fused SDPA vs explicit attention matrix')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--blocks', type=int, default=1, help='Transformer blocks, ViT-L has 24')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    args = parser.parse_args()
+
+    if not attention.SDPA_AVAILABLE:
+        print('torch.nn.functional.scaled_dot_product_attention is not available in this PyTorch')
+        return
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    blocks = [NestedTensorBlock(DIM, HEADS, qkv_bias=True, attn_class=MemEffAttention).to(device).eval()
+              for _ in range(args.blocks)]
+    x = torch.randn(args.batch_size, TOKENS, DIM, device=device)
+    print(f'device: {device}  blocks: {args.blocks}  tokens: {TOKENS}  xFormers: {attention.XFORMERS_AVAILABLE}')
+
+    # Fused first, the CPU peak (max RSS) only grows, so the explicit matrix shows up as an increase
+    outputs = {}
+    for name, use_sdpa in (('sdpa', True), ('explicit', False)):
+        attention.USE_SDPA = use_sdpa
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        latencies = measure(blocks, x, args.iterations, args.warmup)
+        with torch.no_grad():
+            outputs[name] = blocks[0](x)
+        print(f'{name:8s} p50: {np.percentile(latencies, 50):8.1f} ms  mean: {np.mean(latencies):8.1f} ms  '
+              f'peak memory: {peak_memory_mib(device):8.1f} MiB')
+    print(f"max abs difference sdpa vs explicit: {(outputs['sdpa'] - outputs['explicit']).abs().max().item():.2e}")
+
+    # Nested tensors of different lengths go through the block-diagonal attention path
+    attention.USE_SDPA = True
+    nested = [torch.randn(2, TOKENS, DIM, device=device), torch.randn(1, TOKENS // 2, DIM, device=device)]
+    with torch.no_grad():
+        joint = blocks[0](nested)
+        separate = [blocks[0](tensor) for tensor in nested]
+    error = max((a - b).abs().max().item() for a, b in zip(joint, separate))
+    print(f'nested vs separate max abs difference: {error:.2e}')
+
+
+if __name__ == '__main__':
+    main()
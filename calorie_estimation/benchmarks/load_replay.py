@@ -0,0 +1,224 @@
+# Load-replay benchmark for the Flask app. Replays image + detection payloads against
+# deep_learning_server.app in-process at a fixed request rate and concurrency, and reports
+# latency percentiles, throughput and the per-stage medians from the Server-Timing headers.
+# Run from the calorie_estimation directory. On a machine without checkpoints or a GPU:
+#   CUDA_VISIBLE_DEVICES= CALORIE_STUB_MODELS=1 python benchmarks/load_replay.py --qps 10 --requests 100
+# Record payloads once, from real photos (detections come from /yolo) or synthesized plates:
+#   python benchmarks/load_replay.py --images photos/ --record payloads/
+#   python benchmarks/load_replay.py --synthesize 16 --record payloads/
+# and replay them, failing when p95 latency or throughput regress against a saved report:
+#   python benchmarks/load_replay.py --payloads payloads/ --output report.json
+#   python benchmarks/load_replay.py --payloads payloads/ --baseline report.json --tolerance 0.2
+# The SAM embedding and /calorie result caches are off unless --caches is given, since a few
+# payloads replayed many times would otherwise measure cache lookups instead of inference.
+
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+ENDPOINTS = ['calorie', 'analyze', 'yolo']
+
+
+def synthesize_payload(rng, size=640):
+    # A plate on a table with a coin and a few food items, detections are the drawn shapes
+    image = np.full((size, size, 3), rng.integers(80, 160, 3), dtype=np.uint8)
+    cv2.circle(image, (size // 2, size // 2), int(size * 0.45), (235, 235, 235), -1)
+    detections = []
+
+    cx, cy, r = int(size * 0.15), int(size * 0.85), int(size * 0.04)
+    cv2.circle(image, (cx, cy), r, (60, 140, 190), -1)
+    detections.append({'class': 0, 'name': 'coin', 'confidence': 0.95, 'bbox': [cx - r, cy - r, cx + r, cy + r]})
+
+    for class_id, name in [(1, 'cabbage'), (2, 'fried potato'), (3, 'grilled pork')]:
+        cx, cy = (int(v) for v in rng.integers(int(size * 0.3), int(size * 0.7), 2))
+        rx, ry = (int(v) for v in rng.integers(int(size * 0.05), int(size * 0.12), 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.ellipse(image, (cx, cy), (rx, ry), float(rng.uniform(0, 180)), 0, 360, color, -1)
+        detections.append({'class': class_id, 'name': name, 'confidence': float(rng.uniform(0.5, 0.95)),
+                           'bbox': [cx - max(rx, ry), cy - max(rx, ry), cx + max(rx, ry), cy + max(rx, ry)]})
+
+    ok, encoded = cv2.imencode('.png', image)
+    return {'image': encoded.tobytes(), 'detections': detections}
+
+
+def record_from_images(client, image_dir):
+    # Detections for real photos come from the server's own /yolo
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+        with open(path, 'rb') as f:
+            image = f.read()
+        response = client.post('/yolo', data={'image': (io.BytesIO(image), os.path.basename(path))},
+                               content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f'/yolo failed for {path} with status {response.status_code}')
+        payloads.append({'image': image, 'detections': response.get_json()})
+    return payloads
+
+
+def save_payloads(payloads, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for i, payload in enumerate(payloads):
+        with open(os.path.join(out_dir, f'{i:04d}.img'), 'wb') as f:
+            f.write(payload['image'])
+        with open(os.path.join(out_dir, f'{i:04d}.json'), 'w') as f:
+            json.dump(payload['detections'], f)
+
+
+def load_payloads(payload_dir):
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(payload_dir, '*.img'))):
+        with open(path, 'rb') as f:
+            image = f.read()
+        with open(path[:-len('.img')] + '.json') as f:
+            payloads.append({'image': image, 'detections': json.load(f)})
+    return payloads
+
+
+def post(client, endpoint, payload):
+    data = {'image': (io.BytesIO(payload['image']), 'image.png')}
+    if endpoint == 'calorie':
+        data['data'] = (io.BytesIO(json.dumps(payload['detections']).encode()), 'data.json')
+    return client.post(f'/{endpoint}', data=data, content_type='multipart/form-data')
+
+
+def parse_server_timing(header):
+    timings = {}
+    for entry in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, duration = entry.partition(';dur=')
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def replay(app, payloads, endpoint, requests, qps, concurrency):
+    # Open loop at qps: request i is due at i / qps and its latency counts from then, so queueing
+    # under overload is measured instead of hidden. qps 0 sends back to back from every thread.
+    clients = threading.local()
+    latencies, stage_timings, errors = [], {}, []
+    lock = threading.Lock()
+
+    def request(i, due):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        started = due if qps > 0 else time.perf_counter()
+        response = post(clients.client, endpoint, payloads[i % len(payloads)])
+        latency = 1000 * (time.perf_counter() - started)
+        with lock:
+            if response.status_code != 200:
+                errors.append(response.status_code)
+                return
+            latencies.append(latency)
+            for name, ms in parse_server_timing(response.headers.get('Server-Timing')).items():
+                stage_timings.setdefault(name, []).append(ms)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(request, i, started + i / qps if qps > 0 else started) for i in range(requests)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'endpoint': endpoint,
+        'requests': requests,
+        'errors': len(errors),
+        'qps_target': qps,
+        'concurrency': concurrency,
+        'throughput': len(latencies) / elapsed,
+        'latency_ms': {f'p{q}': percentile(latencies, q) for q in (50, 95, 99)},
+        'stage_p50_ms': {name: percentile(values, 50) for name, values in stage_timings.items()},
+    }
+
+
+def check_regression(report, baseline, tolerance):
+    failures = []
+    if report['latency_ms']['p95'] > baseline['latency_ms']['p95'] * (1 + tolerance):
+        failures.append(f"p95 latency {report['latency_ms']['p95']:.1f} ms vs {baseline['latency_ms']['p95']:.1f} ms")
+    if report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        failures.append(f"throughput {report['throughput']:.2f} req/s vs {baseline['throughput']:.2f} req/s")
+    if report['errors'] > baseline['errors']:
+        failures.append(f"{report['errors']} errors vs {baseline['errors']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay image + detection payloads against the Flask app')
+    parser.add_argument('--payloads', type=str, default=None, help='Directory written by --record')
+    parser.add_argument('--images', type=str, default=None, help='Directory of photos to record payloads from')
+    parser.add_argument('--synthesize', type=int, default=8, help='Synthetic payloads when no payloads are given')
+    parser.add_argument('--record', type=str, default=None, help='Save the payloads to this directory and exit')
+    parser.add_argument('--endpoint', choices=ENDPOINTS, default='calorie')
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--qps', type=float, default=0, help='Target request rate, 0 sends back to back')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', type=str, default=None, help='Write the report as JSON')
+    parser.add_argument('--baseline', type=str, default=None, help='Report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression against the baseline')
+    parser.add_argument('--caches', action='store_true',
+                        help='Keep the SAM embedding and result caches on, to measure repeated uploads')
+    args = parser.parse_args()
+
+    if not args.caches:
+        os.environ['SAM_CACHE_MAX_ENTRIES'] = '0'
+        os.environ['RESULT_CACHE_MAX_ENTRIES'] = '0'
+    from deep_learning_server import app
+    from model_registry import STUB_MODELS
+    client = app.test_client()
+
+    if args.payloads:
+        payloads = load_payloads(args.payloads)
+    elif args.images:
+        payloads = record_from_images(client, args.images)
+    else:
+        rng = np.random.default_rng(0)
+        payloads = [synthesize_payload(rng) for _ in range(args.synthesize)]
+    if args.record:
+        save_payloads(payloads, args.record)
+        print(f'recorded {len(payloads)} payloads to {args.record}')
+        return
+
+    for i in range(args.warmup):
+        post(client, args.endpoint, payloads[i % len(payloads)])
+
+    report = replay(app, payloads, args.endpoint, args.requests, args.qps, args.concurrency)
+    report['stub_models'] = STUB_MODELS
+    report['caches'] = args.caches
+    print(f"/{report['endpoint']}  requests: {report['requests']}  errors: {report['errors']}  "
+          f"qps: {args.qps or 'max'}  concurrency: {args.concurrency}  stub models: {STUB_MODELS}")
+    print(f"throughput: {report['throughput']:.2f} req/s")
+    print('latency ms  ' + '  '.join(f'{q}: {ms:.1f}' for q, ms in report['latency_ms'].items()))
+    print('stage p50 ms  ' + '  '.join(f'{name}: {ms:.1f}' for name, ms in report['stage_p50_ms'].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = check_regression(report, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f'regression: {failure}')
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
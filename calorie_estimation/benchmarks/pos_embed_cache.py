@@ -0,0 +1,75 @@
+# Cost of the DINOv2 positional-embedding interpolation per forward and what the resolution-keyed
+# cache saves. The ViT-L/14 of Depth-Anything is pretrained at 518x518 (37 x 37 patches), so every
+# other input size interpolates the 1370 x 1024 table; the server's depth input is 45 x 45 patches.
+# Also checks that cached and freshly interpolated tables are identical. Run from the
+# calorie_estimation directory:
+#   CUDA_VISIBLE_DEVICES= python benchmarks/pos_embed_cache.py --iterations 200
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath('./data/models/Depth-Anything/torchhub/facebookresearch_dinov2_main'))
+
+from vision_transformer import vit_large
+
+PATCH_SIZE = 14
+
+
+def measure(model, x, size, iterations, use_cache):
+    latencies = []
+    with torch.no_grad():
+        for _ in range(iterations):
+            started = time.perf_counter()
+            if use_cache:
+                model.interpolate_pos_encoding(x, size, size)
+            else:
+                model._interpolate_pos_encoding(x, size, size)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            latencies.append(1000 * (time.perf_counter() - started))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DINOv2 positional embedding interpolation with and without the cache')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[630, 448, 896], help='Input sizes in pixels')
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = vit_large(patch_size=PATCH_SIZE, img_size=518, init_values=1.0, block_chunks=0).to(device).eval()
+    print(f'device: {device}  pretrained grid: {model.pos_embed.shape[1] - 1} patches')
+
+    for size in args.sizes:
+        patches = (size // PATCH_SIZE) ** 2
+        x = torch.zeros(1, patches + 1, model.embed_dim, device=device)
+        model.pos_embed_cache.clear()
+        uncached = measure(model, x, size, args.iterations, use_cache=False)
+        cached = measure(model, x, size, args.iterations, use_cache=True)
+        with torch.no_grad():
+            error = (model.interpolate_pos_encoding(x, size, size) - model._interpolate_pos_encoding(x, size, size))
+        print(f'{size}x{size} ({size // PATCH_SIZE}x{size // PATCH_SIZE} patches)  '
+              f'interpolate p50: {np.percentile(uncached, 50):7.3f} ms  cached p50: {np.percentile(cached, 50):7.3f} ms  '
+              f'saved per forward: {np.percentile(uncached, 50) - np.percentile(cached, 50):7.3f} ms  '
+              f'max abs difference: {error.abs().max().item():.1e}')
+
+    # Loading weights must not serve tables interpolated from the old ones
+    x = torch.zeros(1, (args.sizes[0] // PATCH_SIZE) ** 2 + 1, model.embed_dim, device=device)
+    with torch.no_grad():
+        before = model.interpolate_pos_encoding(x, args.sizes[0], args.sizes[0]).clone()
+        state = model.state_dict()
+        state['pos_embed'] = torch.randn_like(state['pos_embed'])
+        model.load_state_dict(state)
+        after = model.interpolate_pos_encoding(x, args.sizes[0], args.sizes[0])
+    print(f'table changed after load_state_dict: {not torch.equal(before, after)}')
+    print(f'cache stats: {model.pos_embed_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Time-to-first-inference per model, for comparing original and consolidated checkpoints.
+# Run from the calorie_estimation directory, once per configuration and in a fresh process each time:
+#   python benchmarks/startup.py
+#   CONSOLIDATED_CHECKPOINT_DIR=/nonexistent python benchmarks/startup.py
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+from model_registry import model_registry, consolidated_path
+
+
+def first_inference(name, model, device):
+    image = np.random.default_rng(0).integers(0, 256, (640, 640, 3), dtype=np.uint8)
+    with torch.no_grad():
+        if name == 'sam_model':
+            from segment_anything import SamPredictor
+            SamPredictor(model).set_image(image)
+        elif name == 'depth_model':
+            model(torch.rand(1, 3, 640, 640, device=device), dataset='nyu')
+        elif name == 'yolo_model':
+            model(image)
+        elif name == 'regression_model':
+            model.predict(pd.DataFrame({'object_id': [0], 'area': [10.0], 'volume': [10.0]}))
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model startup benchmark')
+    parser.add_argument('--models', nargs='+', default=list(model_registry.loaders))
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print(f'{"model":<18}{"source":<14}{"load s":>10}{"first inference s":>20}{"total s":>10}')
+    for name in args.models:
+        started = time.perf_counter()
+        model = model_registry.get(name, args.device)
+        loaded = time.perf_counter()
+        first_inference(name, model, args.device)
+        finished = time.perf_counter()
+        source = 'consolidated' if consolidated_path(name) else 'original'
+        print(f'{name:<18}{source:<14}{loaded - started:>10.2f}{finished - loaded:>20.2f}{finished - started:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
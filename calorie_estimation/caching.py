@@ -0,0 +1,151 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUTTLCache:
+    # Bounded cache with least-recently-used and time-to-live eviction.
+    # `sizeof` returns the memory footprint of a value in bytes so the cache
+    # can be bounded by bytes as well as by entry count.
+    def __init__(self, max_entries=32, ttl=300, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if self.ttl is not None and time.monotonic() > expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires_at)
+            self.current_bytes += size
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def _evict(self):
+        # Drop expired entries first, then the least recently used ones
+        if self.ttl is not None:
+            now = time.monotonic()
+            for key in [k for k, (_, _, expires_at) in self.entries.items() if now > expires_at]:
+                self._remove(key)
+                self.expirations += 1
+        while len(self.entries) > self.max_entries or \
+                (self.max_bytes is not None and self.current_bytes > self.max_bytes):
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class ResultCache:
+    # LRUTTLCache of finished results plus single-flight deduplication: while a key is being
+    # computed, identical requests wait on the same Future instead of computing it again.
+    # Failures are passed to the waiters but not cached.
+    def __init__(self, max_entries=1024, ttl=600, max_bytes=None, sizeof=None):
+        self.results = LRUTTLCache(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes, sizeof=sizeof)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def claim(self, key):
+        # Returns (future, owner). The owner computes the result and hands it to complete() or fail()
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.hits += 1
+                future = Future()
+                future.set_result(result)
+                return future, False
+            if key in self.in_flight:
+                self.coalesced += 1
+                return self.in_flight[key], False
+            self.misses += 1
+            future = self.in_flight[key] = Future()
+            return future, True
+
+    def complete(self, key, future, result):
+        with self.lock:
+            self.results.put(key, result)
+            self.in_flight.pop(key, None)
+        future.set_result(result)
+
+    def fail(self, key, future, error):
+        with self.lock:
+            self.in_flight.pop(key, None)
+        future.set_exception(error)
+
+    def get_or_compute(self, key, compute):
+        future, owner = self.claim(key)
+        if owner:
+            try:
+                result = compute()
+            except Exception as e:
+                self.fail(key, future, e)
+                raise
+            self.complete(key, future, result)
+        return future.result()
+
+    def stats(self):
+        stats = self.results.stats()
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            stats.update({
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.in_flight),
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            })
+        return stats
@@ -13,8 +13,16 @@ import torchvision.transforms as transforms
 import open3d as o3d
 from tqdm import tqdm
 from zoedepth.models.builder import build_model
+from zoedepth.models.zoedepth.zoedepth_v1 import ZoeDepth
 from zoedepth.utils.config import get_config
 import io
+import time
+import queue
+import threading
+from collections import Counter, deque
+from functools import lru_cache
+from contextlib import nullcontext
+from concurrent.futures import Future
 
 # Global settings
 FL = 715.0873
@@ -24,32 +32,320 @@ NYU_DATA = False
 FINAL_HEIGHT = 640
 FINAL_WIDTH = 640
 DATASET = 'nyu' # Lets not pick a fight with the model's dataloader
+# Average each prediction with that of the mirrored image, as DepthModel.infer_with_flip_aug does
+DEPTH_FLIP_AUG = os.environ.get('DEPTH_FLIP_AUG', '0') == '1'
+# Run inputs larger than the model's native resolution as overlapping tiles, see DepthModel.infer_tiled
+DEPTH_TILED = os.environ.get('DEPTH_TILED', '0') == '1'
+# Compute metric depth only inside the detected boxes, grown by DEPTH_ROI_MARGIN pixels
+DEPTH_ROI = os.environ.get('DEPTH_ROI', '0') == '1'
+DEPTH_ROI_MARGIN = int(os.environ.get('DEPTH_ROI_MARGIN', 16))
 
-def process_images(model, image_bytes, device):
+def image_to_tensor(image):
+    # Accepts a PIL image or an HWC uint8 array
+    return transforms.ToTensor()(image).unsqueeze(0)
+
+def load_image_tensor(image_bytes):
+    image_stream = io.BytesIO(image_bytes)
+    color_image = Image.open(image_stream).convert('RGB')
+    return image_to_tensor(color_image)
+
+def extract_metric_depth(pred):
+    if isinstance(pred, dict):
+        pred = pred.get('metric_depth', pred.get('out'))
+    elif isinstance(pred, (list, tuple)):
+        pred = pred[-1]
+    return pred
+
+def supports_roi(model):
+    # The ROI path is ZoeDepth's eager forward on whole images, without tiles or flipped copies
+    return getattr(model, 'supports_roi', False) and not isinstance(model.forward, CompiledForward) \
+        and not DEPTH_TILED and not DEPTH_FLIP_AUG
+
+def roi_mask(boxes, height=FINAL_HEIGHT, width=FINAL_WIDTH, margin=DEPTH_ROI_MARGIN):
+    # Pixels whose depth is needed, the union of the [x0, y0, x1, y1] boxes grown by margin
+    mask = torch.zeros(height, width, dtype=torch.bool)
+    for x0, y0, x1, y1 in boxes:
+        mask[max(0, int(y0) - margin):max(0, int(y1) + margin + 1),
+             max(0, int(x0) - margin):max(0, int(x1) + margin + 1)] = True
+    return mask
+
+def roi_depth_map(pred, roi, scale=1.0):
+    # FINAL_HEIGHT x FINAL_WIDTH depth from the values computed inside the roi, 0 (no reading) elsewhere.
+    # Cells are rebuilt on the host from the roi, only the depth values come back from the device.
+    h, w = pred['output_size']
+    cells = ZoeDepth.roi_cells(roi.unsqueeze(0), (h, w))[0].numpy()
+    grid = np.zeros((h, w), dtype=np.float32)
+    grid[cells] = (pred['roi_depth'][0].detach().float() * scale).cpu().numpy()
+    rows = ((np.arange(FINAL_HEIGHT) + 0.5) * h / FINAL_HEIGHT).astype(np.int64).clip(max=h - 1)
+    cols = ((np.arange(FINAL_WIDTH) + 0.5) * w / FINAL_WIDTH).astype(np.int64).clip(max=w - 1)
+    depth = grid[rows[:, None], cols[None, :]]
+    depth[~roi.numpy()] = 0
+    return depth
+
+def depth_forward(model, images, roi=None, img_size=None, autocast_dtype=None):
+    # img_size overrides the network input size and autocast_dtype runs the forward under autocast,
+    # both per call for the quality tiers. Tiles are always run at the native size.
+    if autocast_dtype is not None:
+        with torch.autocast(images.device.type, dtype=autocast_dtype):
+            return depth_forward(model, images, roi, img_size)
+    kwargs = {'img_size': img_size} if img_size is not None else {}
+    if roi is not None:
+        return model(images, dataset=DATASET, roi=roi, **kwargs)
+    if DEPTH_TILED and hasattr(model, 'infer_tiled'):
+        # Tiles, and their mirrors with the flip augmentation, are batched inside infer_tiled
+        return model.infer_tiled(images, pad_input=False, with_flip_aug=DEPTH_FLIP_AUG)
+    if not DEPTH_FLIP_AUG:
+        return extract_metric_depth(model(images, dataset=DATASET, **kwargs))
+    # The images and their mirrors run as one batch of twice the size instead of two forwards
+    pred = extract_metric_depth(model(torch.cat([images, torch.flip(images, dims=[3])]), dataset=DATASET, **kwargs))
+    pred, pred_flip = pred.chunk(2)
+    return (pred + torch.flip(pred_flip, dims=[-1])) / 2
+
+def resize_depth(pred, scale=1.0):
+    # Resized and scaled to the caller's units (scale 100 gives centimeters) on the prediction's device,
+    # then copied to the host once as a float32 array. 'nearest-exact' picks the same source pixels
+    # as PIL's NEAREST resize.
+    pred = pred.detach().float().reshape(1, 1, *pred.shape[-2:])
+    pred = torch.nn.functional.interpolate(pred, size=(FINAL_HEIGHT, FINAL_WIDTH), mode='nearest-exact')
+    if scale != 1:
+        pred.mul_(scale)
+    return pred[0, 0].cpu().numpy()
+
+def process_images(model, image_bytes, device, batcher=None, scale=1.0):
     try:
-        image_stream = io.BytesIO(image_bytes)
-        color_image = Image.open(image_stream).convert('RGB')
-        original_width, original_height = color_image.size
-        image_tensor = transforms.ToTensor()(color_image).unsqueeze(0).to(device)
-
-        pred = model(image_tensor, dataset=DATASET)
-        if isinstance(pred, dict):
-            pred = pred.get('metric_depth', pred.get('out'))
-        elif isinstance(pred, (list, tuple)):
-            pred = pred[-1]
-        pred = pred.squeeze().detach().cpu().numpy()
-        
-        resized_pred = Image.fromarray(pred).resize((FINAL_WIDTH, FINAL_HEIGHT), Image.NEAREST)
-        return resized_pred
+        return process_image_tensor(model, load_image_tensor(image_bytes), device, batcher, scale=scale)
     except Exception as e:
         print(f"Error processing image: {e}")
 
-def depth_estimation(image_bytes):
-    model_name = 'zoedepth'
-    pretrained_resource = 'local::data/models/Depth-Anything/metric_depth/checkpoints/nutrition5k_03-May_12-04-b56f6cfdfe15_latest.pt'
+def process_image_tensor(model, image_tensor, device, batcher=None, roi=None, scale=1.0, img_size=None,
+                         autocast_dtype=None):
+    # FINAL_HEIGHT x FINAL_WIDTH float32 depth in meters times scale.
+    # With a roi (H, W) mask and a model that supports it, depth outside the roi is 0
+    if roi is not None and not supports_roi(model):
+        roi = None
+    if batcher is not None:
+        pred = batcher.infer(image_tensor, roi, img_size, autocast_dtype)
+    else:
+        # Grad mode as in the batcher and the compile warm-up, so the compiled graph's guards hold
+        with torch.no_grad():
+            pred = depth_forward(model, image_tensor.to(device), None if roi is None else roi.unsqueeze(0),
+                                 img_size, autocast_dtype)
+    if roi is not None:
+        return roi_depth_map(pred, roi, scale)
+    return resize_depth(pred, scale)
+
+class DepthBatcher:
+    # Gathers depth requests from concurrent callers on one device and runs them as a single
+    # batched forward. A batch is dispatched once max_batch_size requests are queued or the
+    # oldest request has waited max_wait_ms, whichever comes first.
+    def __init__(self, model, device, max_batch_size=4, max_wait_ms=5, stats_window=1024):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.batch_size_histogram = Counter()
+        self.wait_times = deque(maxlen=stats_window)
+        self.worker = threading.Thread(target=self._run, name=f'depth-batcher-{device}', daemon=True)
+        self.worker.start()
+
+    def submit(self, image_tensor, roi=None, img_size=None, autocast_dtype=None):
+        future = Future()
+        self.queue.put((image_tensor, future, time.monotonic(), roi, (img_size, autocast_dtype)))
+        return future
+
+    def infer(self, image_tensor, roi=None, img_size=None, autocast_dtype=None):
+        # The prediction was computed on the batcher's stream. The caller's stream, e.g. a parallel
+        # stage's own, waits for it, and the allocator keeps the memory until that stream is done.
+        pred, event = self.submit(image_tensor, roi, img_size, autocast_dtype).result()
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for tensor in pred['roi_depth'] if isinstance(pred, dict) else [pred]:
+                tensor.record_stream(stream)
+        return pred
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Only inputs of the same shape and settings, and all with or all without a roi, can share a forward
+            groups = {}
+            for item in batch:
+                groups.setdefault((tuple(item[0].shape), item[3] is None, item[4]), []).append(item)
+            for items in groups.values():
+                self._forward(items)
+
+    def _forward(self, items):
+        started = time.monotonic()
+        with self.stats_lock:
+            self.batch_size_histogram[len(items)] += 1
+            self.wait_times.extend(started - enqueued for _, _, enqueued, _, _ in items)
+        try:
+            with torch.no_grad():
+                images = torch.cat([image for image, _, _, _, _ in items]).to(self.device)
+                roi = torch.stack([roi for _, _, _, roi, _ in items]) if items[0][3] is not None else None
+                pred = depth_forward(self.model, images, roi, *items[0][4])
+            event = None
+            if torch.device(self.device).type == 'cuda':
+                event = torch.cuda.Event()
+                event.record(torch.cuda.current_stream(self.device))
+            for i, (_, future, _, _, _) in enumerate(items):
+                if roi is not None:
+                    future.set_result(({'roi_depth': pred['roi_depth'][i:i + 1], 'output_size': pred['output_size']},
+                                       event))
+                else:
+                    future.set_result((pred[i:i + 1], event))
+        except Exception as e:
+            for _, future, _, _, _ in items:
+                future.set_exception(e)
+
+    def stats(self):
+        with self.stats_lock:
+            wait_times = sorted(self.wait_times)
+            histogram = dict(sorted(self.batch_size_histogram.items()))
+        stats = {
+            'queue_depth': self.queue.qsize(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size_histogram': histogram,
+        }
+        if wait_times:
+            stats['wait_ms'] = {
+                'mean': 1000 * sum(wait_times) / len(wait_times),
+                'p50': 1000 * wait_times[len(wait_times) // 2],
+                'p99': 1000 * wait_times[min(len(wait_times) - 1, int(len(wait_times) * 0.99))],
+                'max': 1000 * wait_times[-1],
+            }
+        return stats
 
+class CompiledForward:
+    # Replaces a model's forward with a torch.compile'd one. If compiling or running the compiled
+    # graph fails, the eager forward is used from then on and the error is kept for /stats.
+    def __init__(self, model, mode=None):
+        self.eager = model.forward
+        self.compiled = torch.compile(self.eager, mode=mode, dynamic=False)
+        self.mode = mode or 'default'
+        self.error = None
+        self.warmup_seconds = None
+
+    def __call__(self, *args, **kwargs):
+        if self.error is None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                self.error = repr(e)
+                print(f"Compiled depth forward failed, falling back to eager: {e}")
+        return self.eager(*args, **kwargs)
+
+    def stats(self):
+        return {'mode': self.mode, 'warmup_seconds': self.warmup_seconds, 'eager_fallback': self.error}
+
+def raise_recompile_limit(graphs):
+    # Past dynamo's limit of graphs per function it silently runs the function eagerly
+    import torch._dynamo
+    config = torch._dynamo.config
+    name = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+    setattr(config, name, max(getattr(config, name), graphs))
+
+def compile_depth_model(model, device, mode=None, batch_sizes=(1,), variants=((None, None),)):
+    # Every request is resized to FINAL_HEIGHT x FINAL_WIDTH, so the graph is compiled once per
+    # batch size the batcher can form and per (img_size, autocast dtype) of the quality tiers,
+    # here at startup instead of on the first requests of a tier, which arrive under load
+    compiled = CompiledForward(model, mode)
+    model.forward = compiled
+    raise_recompile_limit(len(batch_sizes) * len(variants) + 1)
+    started = time.perf_counter()
+    with torch.no_grad():
+        for img_size, autocast_dtype in variants:
+            kwargs = {'img_size': img_size} if img_size is not None else {}
+            with torch.autocast(torch.device(device).type, dtype=autocast_dtype) \
+                    if autocast_dtype is not None else nullcontext():
+                for batch_size in batch_sizes:
+                    model(torch.zeros(batch_size, 3, FINAL_HEIGHT, FINAL_WIDTH, device=device), dataset=DATASET,
+                          **kwargs)
+    compiled.warmup_seconds = time.perf_counter() - started
+    return compiled
+
+PRETRAINED_RESOURCE = 'local::data/models/Depth-Anything/metric_depth/checkpoints/nutrition5k_03-May_12-04-b56f6cfdfe15_latest.pt'
+
+def load_depth_model(device, pretrained_resource=PRETRAINED_RESOURCE):
+    model_name = 'zoedepth'
     config = get_config(model_name, "eval", DATASET)
     config.pretrained_resource = pretrained_resource
-    model = build_model(config).to('cuda' if torch.cuda.is_available() else 'cpu')
+    model = build_model(config).to(device)
     model.eval()
-    return process_images(model, image_bytes, 'cuda' if torch.cuda.is_available() else 'cpu')
+    return model
+
+# 'torch' runs the PyTorch model, 'onnx' the graph written by tools/export_depth_onnx.py on ONNX Runtime
+DEPTH_BACKEND = os.environ.get('DEPTH_BACKEND', 'torch')
+ONNX_MODEL_PATH = os.environ.get('DEPTH_ONNX_PATH', './data/models/depth_model.onnx')
+ONNX_SESSIONS = int(os.environ.get('DEPTH_ONNX_SESSIONS', 2))  # Concurrent inferences on the ONNX backend
+
+class MetricDepthOutput(torch.nn.Module):
+    # The depth model with a single tensor in and out, the signature the ONNX graph is traced with
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return extract_metric_depth(self.model(image, dataset=DATASET))
+
+class OnnxDepthModel(torch.nn.Module):
+    # Runs the exported depth graph on a pool of ONNX Runtime sessions. Called like the PyTorch
+    # model, so process_images and DepthBatcher use either backend. Sessions are created in the
+    # process that uses them, forked CPU workers build their own.
+    def __init__(self, path=ONNX_MODEL_PATH, sessions=ONNX_SESSIONS, threads=None):
+        super().__init__()
+        self.path = path
+        self.size = max(1, sessions)
+        self.threads = threads or max(1, torch.get_num_threads() // self.size)
+        self.pool = None
+        self.pid = None
+        self.pool_lock = threading.Lock()
+
+    def _session_pool(self):
+        with self.pool_lock:
+            if self.pid != os.getpid():
+                import onnxruntime as ort
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                options.inter_op_num_threads = 1
+                self.pool = queue.Queue()
+                for _ in range(self.size):
+                    self.pool.put(ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider']))
+                self.pid = os.getpid()
+            return self.pool
+
+    def forward(self, image, dataset=DATASET, **kwargs):
+        pool = self._session_pool()
+        session = pool.get()
+        try:
+            (depth,) = session.run(None, {'image': image.detach().cpu().float().numpy()})
+        finally:
+            pool.put(session)
+        return {'metric_depth': torch.from_numpy(depth).to(image.device)}
+
+@lru_cache(maxsize=None)
+def get_depth_model(device, pretrained_resource=PRETRAINED_RESOURCE, backend=None):
+    # Build the model once per device instead of on every call
+    if (backend or DEPTH_BACKEND) == 'onnx':
+        return OnnxDepthModel()
+    return load_depth_model(device, pretrained_resource)
+
+def depth_estimation(image_bytes):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return process_images(get_depth_model(device), image_bytes, device)
@@ -184,9 +184,25 @@ class PrepForMidas(object):
             mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         self.resizer = Resize(net_w, net_h, keep_aspect_ratio=keep_aspect_ratio, ensure_multiple_of=14, resize_method=resize_mode) \
             if do_resize else nn.Identity()
+        self.keep_aspect_ratio = keep_aspect_ratio
+        self.resize_mode = resize_mode
+        self.do_resize = do_resize
+        self.resizers = {}
+
+    def get_resizer(self, img_size=None):
+        # resizers to other network input sizes, made once per size
+        if img_size is None or not self.do_resize:
+            return self.resizer
+        if isinstance(img_size, int):
+            img_size = (img_size, img_size)
+        img_size = tuple(img_size)
+        if img_size not in self.resizers:
+            self.resizers[img_size] = Resize(img_size[1], img_size[0], keep_aspect_ratio=self.keep_aspect_ratio,
+                                             ensure_multiple_of=14, resize_method=self.resize_mode)
+        return self.resizers[img_size]
 
-    def __call__(self, x):
-        return self.normalization(self.resizer(x))
+    def __call__(self, x, img_size=None):
+        return self.normalization(self.get_resizer(img_size)(x))
 
 
 class DepthAnythingCore(nn.Module):
@@ -217,6 +233,7 @@ class DepthAnythingCore(nn.Module):
         self.set_trainable(trainable)
         self.set_fetch_features(fetch_features)
 
+        self.img_size = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)  # (h, w)
         self.prep = PrepForMidas(keep_aspect_ratio=keep_aspect_ratio,
                                  img_size=img_size, do_resize=kwargs.get('do_resize', True))
 
@@ -258,12 +275,12 @@ class DepthAnythingCore(nn.Module):
                 m.eval()
         return self
 
-    def forward(self, x, denorm=False, return_rel_depth=False):
+    def forward(self, x, denorm=False, return_rel_depth=False, img_size=None):
         # print('input to midas:', x.shape)
         with torch.no_grad():
             if denorm:
                 x = denormalize(x)
-            x = self.prep(x)
+            x = self.prep(x, img_size)
         
         with torch.set_grad_enabled(self.trainable):
 
@@ -331,15 +348,16 @@ class DepthAnythingCore(nn.Module):
         self.output_channels = [256, 256, 256, 256, 256]
 
     @staticmethod
-    def build(midas_model_type="dinov2_large", train_midas=False, use_pretrained_midas=True, fetch_features=False, freeze_bn=True, force_keep_ar=False, force_reload=False, **kwargs):
+    def build(midas_model_type="dinov2_large", train_midas=False, use_pretrained_midas=True, fetch_features=False, freeze_bn=True, force_keep_ar=False, force_reload=False, load_base_weights=True, **kwargs):
         if "img_size" in kwargs:
             kwargs = DepthAnythingCore.parse_img_size(kwargs)
         img_size = kwargs.pop("img_size", [384, 384])
         
         depth_anything = DPT_DINOv2(out_channels=[256, 512, 1024, 1024], use_clstoken=False)
         
-        state_dict = torch.load('data/models/Depth-Anything/metric_depth/checkpoints/depth_anything_vitl14.pth', map_location='cpu')
-        depth_anything.load_state_dict(state_dict)
+        if load_base_weights:
+            state_dict = torch.load('data/models/Depth-Anything/metric_depth/checkpoints/depth_anything_vitl14.pth', map_location='cpu')
+            depth_anything.load_state_dict(state_dict)
         
         kwargs.update({'keep_aspect_ratio': force_keep_ar})
         
@@ -96,49 +96,139 @@ class DepthModel(nn.Module):
                 out = out[:, :, :, pad_w:-pad_w]
         return out
     
-    def infer_with_flip_aug(self, x, pad_input: bool=True, **kwargs) -> torch.Tensor:
+    def infer_with_flip_aug(self, x, pad_input: bool=True, batch_flip: bool=True, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model with horizontal flip augmentation
         Horizontal flip augmentation improves the accuracy of the model by averaging the output of the model with and without horizontal flip.
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
+            batch_flip (bool, optional): run the image and its flip as one batch of size 2b in a single forward instead of two forwards. Defaults to True.
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
-        # infer with horizontal flip and average
-        out = self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
-        out_flip = self._infer_with_pad_aug(torch.flip(x, dims=[3]), pad_input=pad_input, **kwargs)
+        if batch_flip:
+            # padding is applied per image, so padding the stacked batch is the same as padding each half
+            out = self._infer_with_pad_aug(torch.cat([x, torch.flip(x, dims=[3])]), pad_input=pad_input, **kwargs)
+            out, out_flip = out.chunk(2)
+        else:
+            out = self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
+            out_flip = self._infer_with_pad_aug(torch.flip(x, dims=[3]), pad_input=pad_input, **kwargs)
+        # average with the un-flipped prediction of the flipped image
         out = (out + torch.flip(out_flip, dims=[3])) / 2
         return out
     
-    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, **kwargs) -> torch.Tensor:
+    def native_size(self):
+        """
+        Resolution (h, w) the network resizes its input to, the default tile size of infer_tiled
+        """
+        core = getattr(self, "core", None)
+        if core is None or not hasattr(core, "img_size"):
+            raise NotImplementedError
+        return core.img_size
+    
+    @staticmethod
+    def _tile_starts(length: int, tile: int, overlap: int):
+        # evenly stepped tile offsets along one axis, the last tile aligned to the far edge
+        if length <= tile:
+            return [0]
+        starts = list(range(0, length - tile, max(1, tile - overlap)))
+        return starts + [length - tile]
+    
+    @staticmethod
+    def _feather_window(th: int, tw: int, oh: int, ow: int, device) -> torch.Tensor:
+        # blending weights ramping up linearly from the tile border to 1 at the overlap width
+        def ramp(n, overlap):
+            i = torch.arange(n, device=device, dtype=torch.float32)
+            return torch.clamp(torch.minimum(i + 1, n - i) / (overlap + 1), max=1)
+        return ramp(th, oh)[:, None] * ramp(tw, ow)[None, :]
+    
+    @staticmethod
+    def _align_scale(tile: torch.Tensor, merged: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+        # scale each image's tile so its median depth in the overlap matches the depth merged so far
+        covered = (weight > 0).expand_as(tile)
+        if not covered.any():
+            return tile
+        merged = merged / weight.clamp(min=1e-8)
+        scales = [m[c].median() / t[c].median().clamp(min=1e-6) for t, m, c in zip(tile, merged, covered)]
+        return tile * torch.stack(scales).view(-1, 1, 1, 1)
+    
+    def infer_tiled(self, x, tile_size=None, overlap: float=0.25, tiles_per_batch: int=4, merge: str="feather", **kwargs) -> torch.Tensor:
+        """
+        Inference interface for the model with tiling
+        Inputs larger than the model's native resolution are split into overlapping tiles of that resolution instead of being downscaled, so fine detail is kept and the token count per forward stays fixed.
+        Tiles run through the network tiles_per_batch at a time, which bounds peak activation memory whatever the image size; only the input and the merged output grow with it.
+        Tiles are blended with weights that fade out towards their borders. With merge="median", every tile is first scaled so that its median depth where it overlaps the tiles already merged matches them, which removes seams between tiles predicted at different metric scales.
+        Args:
+            x (torch.Tensor): input tensor of shape (b, c, h, w)
+            tile_size (tuple, optional): tile size (h, w). Defaults to native_size().
+            overlap (float, optional): overlap of neighbouring tiles as a fraction of the tile size. Defaults to 0.25.
+            tiles_per_batch (int, optional): number of tiles run in one forward. Defaults to 4.
+            merge (str, optional): blending of overlapping tiles, 'feather' or 'median'. Defaults to "feather".
+            **kwargs: passed on to infer for every batch of tiles, e.g. pad_input and with_flip_aug
+        Returns:
+            torch.Tensor: output tensor of shape (b, 1, h, w)
+        """
+        assert x.dim() == 4, "x must be 4 dimensional, got {}".format(x.dim())
+        assert merge in ("feather", "median"), "merge must be 'feather' or 'median', got {}".format(merge)
+        assert 0 <= overlap < 1, "overlap must be in [0, 1), got {}".format(overlap)
+
+        b, _, h, w = x.shape
+        th, tw = tile_size or self.native_size()
+        th, tw = min(th, h), min(tw, w)
+        if th == h and tw == w:
+            return self.infer(x, **kwargs)
+
+        oh, ow = int(th * overlap), int(tw * overlap)
+        window = self._feather_window(th, tw, oh, ow, x.device)
+        offsets = [(top, left) for top in self._tile_starts(h, th, oh) for left in self._tile_starts(w, tw, ow)]
+        depth = torch.zeros(b, 1, h, w, device=x.device)
+        weight = torch.zeros(1, 1, h, w, device=x.device)
+        for i in range(0, len(offsets), tiles_per_batch):
+            chunk = offsets[i:i + tiles_per_batch]
+            tiles = torch.cat([x[:, :, top:top + th, left:left + tw] for top, left in chunk])
+            out = self.infer(tiles, **kwargs).float()
+            for (top, left), tile in zip(chunk, out.split(b)):
+                region = (slice(None), slice(None), slice(top, top + th), slice(left, left + tw))
+                if merge == "median":
+                    tile = self._align_scale(tile, depth[region], weight[region])
+                depth[region] += tile * window
+                weight[region] += window
+        return depth / weight
+    
+    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, batch_flip: bool=True, tiled: bool=False, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
             with_flip_aug (bool, optional): whether to use horizontal flip augmentation. Defaults to True.
+            batch_flip (bool, optional): run the flip augmentation as a single forward of size 2b. Defaults to True.
+            tiled (bool, optional): run inputs larger than the native resolution as overlapping tiles, see infer_tiled. Defaults to False.
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
+        if tiled:
+            return self.infer_tiled(x, pad_input=pad_input, with_flip_aug=with_flip_aug, batch_flip=batch_flip, **kwargs)
         if with_flip_aug:
-            return self.infer_with_flip_aug(x, pad_input=pad_input, **kwargs)
+            return self.infer_with_flip_aug(x, pad_input=pad_input, batch_flip=batch_flip, **kwargs)
         else:
             return self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
     
     @torch.no_grad()
-    def infer_pil(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, output_type: str="numpy", **kwargs) -> Union[np.ndarray, PIL.Image.Image, torch.Tensor]:
+    def infer_pil(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, batch_flip: bool=True, tiled: bool=False, output_type: str="numpy", **kwargs) -> Union[np.ndarray, PIL.Image.Image, torch.Tensor]:
         """
         Inference interface for the model for PIL image
         Args:
             pil_img (PIL.Image.Image): input PIL image
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
             with_flip_aug (bool, optional): whether to use horizontal flip augmentation. Defaults to True.
+            batch_flip (bool, optional): run the flip augmentation as a single forward of size 2. Defaults to True.
+            tiled (bool, optional): run images larger than the native resolution as overlapping tiles. Defaults to False.
             output_type (str, optional): output type. Supported values are 'numpy', 'pil' and 'tensor'. Defaults to "numpy".
         """
         x = transforms.ToTensor()(pil_img).unsqueeze(0).to(self.device)
-        out_tensor = self.infer(x, pad_input=pad_input, with_flip_aug=with_flip_aug, **kwargs)
+        out_tensor = self.infer(x, pad_input=pad_input, with_flip_aug=with_flip_aug, batch_flip=batch_flip, tiled=tiled, **kwargs)
         if output_type == "numpy":
             return out_tensor.squeeze().cpu().numpy()
         elif output_type == "pil":
@@ -24,12 +24,13 @@
 
 import torch
 
-def load_state_dict(model, state_dict):
+def load_state_dict(model, state_dict, assign=False):
     """Load state_dict into model, handling DataParallel and DistributedDataParallel. Also checks for "model" key in state_dict.
 
     DataParallel prefixes state_dict keys with 'module.' when saving.
     If the model is not a DataParallel model but the state_dict is, then prefixes are removed.
     If the model is a DataParallel model but the state_dict is not, then prefixes are added.
+    With assign=True the model takes the state_dict tensors as its parameters instead of copying them.
     """
     state_dict = state_dict.get('model', state_dict)
     # if model is a DataParallel model, then state_dict keys are prefixed with 'module.'
@@ -46,14 +47,14 @@ def load_state_dict(model, state_dict):
 
         state[k] = v
 
-    model.load_state_dict(state)
+    model.load_state_dict(state, assign=assign)
     print("Loaded successfully")
     return model
 
 
-def load_wts(model, checkpoint_path):
-    ckpt = torch.load(checkpoint_path, map_location='cpu')
-    return load_state_dict(model, ckpt)
+def load_wts(model, checkpoint_path, mmap=False):
+    ckpt = torch.load(checkpoint_path, map_location='cpu', mmap=mmap)
+    return load_state_dict(model, ckpt, assign=mmap)
 
 
 def load_state_dict_from_url(model, url, **kwargs):
@@ -69,6 +70,10 @@ def load_state_from_resource(model, resource: str):
         2. Local path. Prefixed with "local::"
                 e.g. local::/path/to/ckpt.pt
 
+        3. Memory-mapped local path. Prefixed with "mmap::"
+                e.g. mmap::/path/to/consolidated.pt
+                The file is memory-mapped and its tensors become the model parameters without a copy.
+
 
     Args:
         model (torch.nn.Module): Model
@@ -86,7 +91,11 @@ def load_state_from_resource(model, resource: str):
     elif resource.startswith('local::'):
         path = resource.split('local::')[1]
         return load_wts(model, path)
+
+    elif resource.startswith('mmap::'):
+        path = resource.split('mmap::')[1]
+        return load_wts(model, path, mmap=True)
         
     else:
-        raise ValueError("Invalid resource type, only url:: and local:: are supported")
+        raise ValueError("Invalid resource type, only url::, local:: and mmap:: are supported")
     
\ No newline at end of file
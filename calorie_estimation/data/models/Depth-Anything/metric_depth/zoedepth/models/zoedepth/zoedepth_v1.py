@@ -124,13 +124,18 @@ class ZoeDepth(DepthModel):
         self.conditional_log_binomial = ConditionalLogBinomial(
             last_in, bin_embedding_dim, n_classes=n_bins, min_temp=min_temp, max_temp=max_temp)
 
-    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, **kwargs):
+    # forward accepts roi, see _forward_roi
+    supports_roi = True
+
+    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, roi=None, img_size=None, **kwargs):
         """
         Args:
             x (torch.Tensor): Input image tensor of shape (B, C, H, W)
             return_final_centers (bool, optional): Whether to return the final bin centers. Defaults to False.
             denorm (bool, optional): Whether to denormalize the input image. This reverses ImageNet normalization as midas normalization is different. Defaults to False.
             return_probs (bool, optional): Whether to return the output probability distribution. Defaults to False.
+            roi (torch.Tensor, optional): Boolean mask of shape (B, H', W'). If given, metric depth is only computed where the mask is set, see _forward_roi. Defaults to None.
+            img_size (int, tuple, optional): Network input size (h, w) for this call instead of the configured one. Defaults to None.
         
         Returns:
             dict: Dictionary containing the following keys:
@@ -138,6 +143,7 @@ class ZoeDepth(DepthModel):
                 - metric_depth (torch.Tensor): Metric depth map of shape (B, 1, H, W)
                 - bin_centers (torch.Tensor): Bin centers of shape (B, n_bins). Present only if return_final_centers is True
                 - probs (torch.Tensor): Output probability distribution of shape (B, n_bins, H, W). Present only if return_probs is True
+            With roi, the output of _forward_roi instead.
 
         """
         # print('input shape', x.shape)
@@ -146,7 +152,9 @@ class ZoeDepth(DepthModel):
         # print("input shape:", x.shape)
         self.orig_input_width = w
         self.orig_input_height = h
-        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True)
+        # only DepthAnythingCore takes a per-call input size
+        core_kwargs = dict(img_size=img_size) if img_size is not None else {}
+        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True, **core_kwargs)
         # print("output shapes", rel_depth.shape, out.shape)
         # print('rel_depth shape:', rel_depth.shape)
         # print('out type:', type(out))
@@ -186,6 +194,8 @@ class ZoeDepth(DepthModel):
                 (rel_depth.max() - rel_depth.min())
         # concat rel depth with last. First interpolate rel depth to last size
         rel_cond = rel_depth.unsqueeze(1)
+        if roi is not None:
+            return self._forward_roi(last, rel_cond, b_embedding, b_centers, roi)
         rel_cond = nn.functional.interpolate(
             rel_cond, size=last.shape[2:], mode='bilinear', align_corners=True)
         last = torch.cat([last, rel_cond], dim=1)
@@ -210,6 +220,57 @@ class ZoeDepth(DepthModel):
 
         return output
 
+    @staticmethod
+    def roi_cells(roi, size):
+        """
+        Cells of the output grid that nearest-neighbour resizing to the roi's size samples inside the roi
+        Args:
+            roi (torch.Tensor): boolean mask of shape (B, H', W')
+            size (tuple): (h, w) of the output grid
+        Returns:
+            torch.Tensor: boolean mask of shape (B, h, w)
+        """
+        h, w = size
+        # PIL's and torch's nearest resize read output pixel i from cell floor((i + 0.5) * h / H')
+        rows = ((torch.arange(roi.shape[1], device=roi.device) + 0.5) * h / roi.shape[1]).long().clamp(max=h - 1)
+        cols = ((torch.arange(roi.shape[2], device=roi.device) + 0.5) * w / roi.shape[2]).long().clamp(max=w - 1)
+        cells = torch.zeros(roi.shape[0], h, w, dtype=torch.bool, device=roi.device)
+        n, r, c = roi.nonzero(as_tuple=True)
+        cells[n, rows[r], cols[c]] = True
+        return cells
+
+    def _forward_roi(self, last, rel_cond, b_embedding, b_centers, roi):
+        """
+        The per-pixel head, its upsampled inputs and the bin expectation, evaluated only at the output cells inside roi
+        Args:
+            roi (torch.Tensor): boolean mask of shape (B, H', W') on the grid the caller resizes the depth to
+        Returns:
+            dict: Dictionary containing the following keys:
+                - roi_depth (list): per image, metric depth at the cells of roi_cells(roi, output_size) in row-major order
+                - output_size (tuple): (h, w) of the full output grid
+        """
+        b, _, h, w = last.shape
+        cells = self.roi_cells(roi.to(last.device), (h, w))
+        counts = cells.flatten(1).sum(dim=1).tolist()
+        index = cells.nonzero()  # (K, 3) image, row, column, ordered by image
+        if not index.shape[0]:
+            return dict(roi_depth=[last.new_zeros(0) for _ in range(b)], output_size=(h, w))
+
+        # On grid points, bilinear grid_sample with align_corners gives exactly the values the
+        # full-size interpolations produce there, so only the K cells are ever upsampled
+        grid = torch.stack([2 * index[:, 2] / max(w - 1, 1) - 1, 2 * index[:, 1] / max(h - 1, 1) - 1], dim=-1)
+
+        def sample(t):
+            # (B, C, h', w') -> (1, C, 1, K)
+            samples = [nn.functional.grid_sample(t[i:i + 1], grid[index[:, 0] == i].to(t.dtype).view(1, 1, -1, 2),
+                                                 mode='bilinear', align_corners=True) for i in range(b) if counts[i]]
+            return torch.cat(samples, dim=-1)
+
+        last = last[index[:, 0], :, index[:, 1], index[:, 2]].t().reshape(1, -1, 1, index.shape[0])
+        x = self.conditional_log_binomial(torch.cat([last, sample(rel_cond)], dim=1), sample(b_embedding))
+        out = torch.sum(x * sample(b_centers), dim=1).flatten()
+        return dict(roi_depth=list(out.split(counts)), output_size=(h, w))
+
     def get_lr_params(self, lr):
         """
         Learning rate configuration for different layers of the model
@@ -246,12 +307,17 @@ class ZoeDepth(DepthModel):
         return param_conf
 
     @staticmethod
-    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, **kwargs):
+    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, load_base_weights=None, **kwargs):
         # core = MidasCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
         #                        train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
+
+        # A full pretrained_resource overwrites the Depth-Anything base weights, so only load them when they survive
+        if load_base_weights is None:
+            load_base_weights = use_pretrained_midas or not pretrained_resource
         
         core = DepthAnythingCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
-                                       train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
+                                       train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn,
+                                       load_base_weights=load_base_weights, **kwargs)
         
         model = ZoeDepth(core, **kwargs)
         if pretrained_resource:
@@ -9,16 +9,24 @@
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/models/vision_transformer.py
 
 import logging
+import os
 
+import torch
+import torch.nn.functional as F
 from torch import Tensor
 from torch import nn
 
 
 logger = logging.getLogger("dinov2")
 
+# PyTorch's fused attention kernels, used when xFormers is missing. DINOV2_SDPA=0 restores the
+# explicit softmax(q @ k^T) @ v, which materializes the N x N attention matrix per head.
+SDPA_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+USE_SDPA = SDPA_AVAILABLE and os.environ.get("DINOV2_SDPA", "1") == "1"
+
 
 try:
-    from xformers.ops import memory_efficient_attention, unbind, fmha
+    from xformers.ops import memory_efficient_attention, unbind
 
     XFORMERS_AVAILABLE = True
 except ImportError:
@@ -50,23 +58,89 @@ class Attention(nn.Module):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
 
-        q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
-        attn = q @ k.transpose(-2, -1)
+        if USE_SDPA:
+            # The default scale of scaled_dot_product_attention is head_dim**-0.5, self.scale
+            dropout_p = self.attn_drop.p if self.training else 0.0
+            x = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2], dropout_p=dropout_p)
+        else:
+            q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
+            attn = q @ k.transpose(-2, -1)
 
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
 
+class BlockDiagonalBias:
+    """
+    Stand-in for xFormers' BlockDiagonalMask when it is missing: several sequences concatenated
+    along the token dimension of a batch of one, each attending only to itself
+    """
+
+    def __init__(self, seqlens, batch_sizes=None):
+        self.seqlens = list(seqlens)
+        self._batch_sizes = batch_sizes
+
+    @classmethod
+    def from_seqlens(cls, seqlens):
+        return cls(seqlens)
+
+    def groups(self):
+        # Runs of equal-length sequences, attended to as one batch
+        start = 0
+        i = 0
+        while i < len(self.seqlens):
+            j = i
+            while j < len(self.seqlens) and self.seqlens[j] == self.seqlens[i]:
+                j += 1
+            yield start, j - i, self.seqlens[i]
+            start += (j - i) * self.seqlens[i]
+            i = j
+
+    def attend(self, attention: "Attention", qkv: Tensor) -> Tensor:
+        # qkv: (1, total tokens, 3, heads, head_dim) -> (1, total tokens, heads * head_dim)
+        outputs = []
+        for start, count, length in self.groups():
+            group = qkv[0, start:start + count * length].reshape(count, length, *qkv.shape[2:])
+            group = group.permute(2, 0, 3, 1, 4)
+            if USE_SDPA:
+                dropout_p = attention.attn_drop.p if attention.training else 0.0
+                x = F.scaled_dot_product_attention(group[0], group[1], group[2], dropout_p=dropout_p)
+            else:
+                attn = (group[0] * attention.scale) @ group[1].transpose(-2, -1)
+                x = attention.attn_drop(attn.softmax(dim=-1)) @ group[2]
+            outputs.append(x.transpose(1, 2).reshape(1, count * length, -1))
+        return torch.cat(outputs, dim=1)
+
+    def split(self, x: Tensor):
+        # Inverse of get_attn_bias_and_cat: one (batch, tokens, dim) tensor per nested input
+        outputs = []
+        start = 0
+        index = 0
+        for batch_size in self._batch_sizes or [1] * len(self.seqlens):
+            length = self.seqlens[index]
+            outputs.append(x[:, start:start + batch_size * length].reshape(batch_size, length, *x.shape[2:]))
+            start += batch_size * length
+            index += batch_size
+        return outputs
+
+
 class MemEffAttention(Attention):
     def forward(self, x: Tensor, attn_bias=None) -> Tensor:
         if not XFORMERS_AVAILABLE:
-            assert attn_bias is None, "xFormers is required for nested tensors usage"
-            return super().forward(x)
+            if attn_bias is None:
+                return super().forward(x)
+            B, N, C = x.shape
+            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
+            x = attn_bias.attend(self, qkv)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
 
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
@@ -14,7 +14,7 @@ from typing import Callable, List, Any, Tuple, Dict
 import torch
 from torch import nn, Tensor
 
-from .attention import Attention, MemEffAttention
+from .attention import Attention, BlockDiagonalBias, MemEffAttention
 from .drop_path import DropPath
 from .layer_scale import LayerScale
 from .mlp import Mlp
@@ -32,6 +32,14 @@ except ImportError:
     logger.warning("xFormers not available")
     XFORMERS_AVAILABLE = False
 
+    def index_select_cat(sources, indices):
+        return torch.cat([source[index].flatten() for source, index in zip(sources, indices)])
+
+    def scaled_index_add(input, index, source, scaling=None, alpha=1.0):
+        if scaling is not None:
+            source = source * scaling
+        return torch.index_add(input.flatten(1), 0, index, source.flatten(1), alpha=alpha).view_as(input)
+
 
 class Block(nn.Module):
     def __init__(
@@ -165,7 +173,10 @@ def get_attn_bias_and_cat(x_list, branges=None):
         for b, x in zip(batch_sizes, x_list):
             for _ in range(b):
                 seqlens.append(x.shape[1])
-        attn_bias = fmha.BlockDiagonalMask.from_seqlens(seqlens)
+        if XFORMERS_AVAILABLE:
+            attn_bias = fmha.BlockDiagonalMask.from_seqlens(seqlens)
+        else:
+            attn_bias = BlockDiagonalBias.from_seqlens(seqlens)
         attn_bias._batch_sizes = batch_sizes
         attn_bias_cache[all_shapes] = attn_bias
 
@@ -246,7 +257,7 @@ class NestedTensorBlock(Block):
         if isinstance(x_or_x_list, Tensor):
             return super().forward(x_or_x_list)
         elif isinstance(x_or_x_list, list):
-            assert XFORMERS_AVAILABLE, "Please install xFormers for nested tensors usage"
+            # Without xFormers, MemEffAttention attends to each nested tensor through BlockDiagonalBias
             return self.forward_nested(x_or_x_list)
         else:
             raise AssertionError
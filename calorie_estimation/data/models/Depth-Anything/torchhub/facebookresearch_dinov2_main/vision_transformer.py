@@ -17,7 +17,7 @@ import torch.nn as nn
 import torch.utils.checkpoint
 from torch.nn.init import trunc_normal_
 
-from dinov2.layers import Mlp, PatchEmbed, SwiGLUFFNFused, MemEffAttention, NestedTensorBlock as Block
+from dinov2.layers import Mlp, PatchEmbed, SwiGLUFFNFused, MemEffAttention, NestedTensorBlock as Block, PosEmbedCache
 
 
 logger = logging.getLogger("dinov2")
@@ -108,6 +108,8 @@ class DinoVisionTransformer(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + self.num_tokens, embed_dim))
+        self.pos_embed_cache = PosEmbedCache()
+        self._register_load_state_dict_pre_hook(self._clear_pos_embed_cache)
         assert num_register_tokens >= 0
         self.register_tokens = (
             nn.Parameter(torch.zeros(1, num_register_tokens, embed_dim)) if num_register_tokens else None
@@ -176,12 +178,25 @@ class DinoVisionTransformer(nn.Module):
             nn.init.normal_(self.register_tokens, std=1e-6)
         named_apply(init_weights_vit_timm, self)
 
+    def _clear_pos_embed_cache(self, *args, **kwargs):
+        self.pos_embed_cache.clear()
+
+    def train(self, mode=True):
+        self.pos_embed_cache.clear()
+        return super().train(mode)
+
     def interpolate_pos_encoding(self, x, w, h):
-        previous_dtype = x.dtype
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
+        # The interpolated table only depends on the patch grid, reuse it while the weights are unchanged
+        key = (w // self.patch_size, h // self.patch_size, x.device, x.dtype)
+        return self.pos_embed_cache.get(self.pos_embed, key, lambda: self._interpolate_pos_encoding(x, w, h))
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        previous_dtype = x.dtype
+        N = self.pos_embed.shape[1] - 1
         pos_embed = self.pos_embed.float()
         class_pos_embed = pos_embed[:, 0]
         patch_pos_embed = pos_embed[:, 1:]
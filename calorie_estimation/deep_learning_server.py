@@ -1,17 +1,65 @@
-from flask import Flask, request, jsonify
-from async_utility import calorie_estimation, resize_and_save_image, yolo_detection
+from flask import Flask, request, jsonify, Response
+from async_utility import cached_calorie_estimation, yolo_detection, server_stats, analyze_image
+from quality_tiers import QUALITY_TIERS, tier_selector
+from image_frame import ImageFrame
+from timing import StageTimer
+from metrics import metrics, server_timing
+import threading
 import base64
 import json
 
 app = Flask(__name__)
 
+# Requests currently being served, sampled by /metrics
+in_flight = {'requests': 0}
+in_flight_lock = threading.Lock()
+metrics.add_collector(lambda: [('calorie_requests_in_flight', 'Requests currently being served',
+                                [({}, in_flight['requests'])])])
+
+@app.before_request
+def count_request():
+    with in_flight_lock:
+        in_flight['requests'] += 1
+
+@app.teardown_request
+def uncount_request(error=None):
+    with in_flight_lock:
+        in_flight['requests'] -= 1
+
+def decode(image_data, timer):
+    with timer.stage('decode'):
+        frame = ImageFrame.from_bytes(image_data)
+    metrics.observe('decode', timer.timings['decode'])
+    return frame
+
+def timed_response(result, timer, tier=None):
+    # Serializes the result and reports every stage of the request in a Server-Timing header
+    timer.device = None  # Model work has finished, serializing must not wait on other requests' GPU work
+    with timer.stage('serialize'):
+        response = jsonify(result)
+    metrics.observe('serialize', timer.timings['serialize'])
+    response.headers['Server-Timing'] = server_timing(timer.timings)
+    if tier is not None:
+        response.headers['X-Quality-Tier'] = tier
+    return response
+
+def requested_tier():
+    # Quality tier forced by the client, None leaves the choice to the tier selector
+    return request.values.get('tier') or None
+
 @app.route('/yolo', methods=['POST'])
 def upload_file():
     if request.method == 'POST':
+        forced = requested_tier()
+        if forced is not None and forced not in QUALITY_TIERS:
+            return f'Unknown quality tier, expected one of {list(QUALITY_TIERS)}', 400
+        timer = StageTimer()
         image_data = request.files['image'].read()
-        image_data = resize_and_save_image(image_data)
-        result = yolo_detection(image_data)
-        return jsonify(result)
+        frame = decode(image_data, timer)
+        # The SAM prefetch runs at the tier the load calls for, which the following /calorie most likely gets
+        with tier_selector.request(forced) as tier, timer.stage('inference'):
+            result = yolo_detection(frame, tier=tier, forced=forced is not None)
+        return timed_response(result, timer, tier)
 
 @app.route('/calorie', methods=['POST'])
 def calorie():
@@ -25,12 +73,44 @@ def calorie():
         # Check for JSON data in the request form or as a separate part
         if 'data' in request.files:
             detected_objects = json.loads(request.files['data'].read())
+            forced = requested_tier()
+            if forced is not None and forced not in QUALITY_TIERS:
+                return f'Unknown quality tier, expected one of {list(QUALITY_TIERS)}', 400
 
-            result = calorie_estimation(image_data, detected_objects)
+            # Retries of the same upload at the same tier are answered from the result cache
+            timer = StageTimer()
+            with tier_selector.request(forced, timer) as tier:
+                result = cached_calorie_estimation(image_data, detected_objects, lambda data: decode(data, timer),
+                                                   timer=timer, tier=tier, forced=forced is not None)
 
-            return jsonify(result)
+            return timed_response(result, timer, tier)
 
         return 'Missing image or data', 400
 
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    # Detection, segmentation, depth and mass estimation in a single round-trip
+    if 'image' not in request.files:
+        return 'Missing image', 400
+    forced = requested_tier()
+    if forced is not None and forced not in QUALITY_TIERS:
+        return f'Unknown quality tier, expected one of {list(QUALITY_TIERS)}', 400
+
+    timer = StageTimer()
+    frame = decode(request.files['image'].read(), timer)
+    with tier_selector.request(forced, timer) as tier:
+        result = analyze_image(frame, timer=timer, tier=tier, forced=forced is not None)
+    return timed_response(result, timer, tier)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # Cache hit rates and memory use, depth batching queue depth, batch sizes and wait times
+    return jsonify(server_stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Stage latency histograms, GPU memory high-water marks, queue lengths and model load times
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=8081)
@@ -0,0 +1,167 @@
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+from metrics import metrics
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'All worker queues are full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class DeviceWorker:
+    # Runs model calls for one device on `concurrency` dedicated threads, fed by a bounded queue.
+    # More than one call in flight per device lets the depth batcher group their forwards.
+    def __init__(self, device, max_queue_size=8, concurrency=1):
+        self.device = device
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.concurrency = max(1, concurrency)
+        self.running = 0
+        self.completed = 0
+        self.total_service_time = 0.0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f'worker-{device}-{i}', daemon=True)
+                        for i in range(self.concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.queue.put_nowait((future, fn, args, kwargs))
+        return future
+
+    def pending(self):
+        return self.queue.qsize() + self.running
+
+    def mean_service_time(self):
+        # Seconds between completions with every thread busy
+        return self.total_service_time / self.completed / self.concurrency if self.completed else 1.0
+
+    def _run(self):
+        while True:
+            future, fn, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.running += 1
+            started = time.monotonic()
+            try:
+                future.set_result(fn(*args, device=self.device, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.total_service_time += time.monotonic() - started
+                    self.completed += 1
+                    self.running -= 1
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_size': self.queue.maxsize,
+            'running': self.running,
+            'concurrency': self.concurrency,
+            'completed': self.completed,
+            'mean_service_ms': 1000 * self.mean_service_time(),
+        }
+
+
+class DeviceWorkerPool:
+    # One worker per device. Work goes to the least loaded worker; when every queue is full
+    # QueueFull is raised with an estimate of when capacity frees up.
+    def __init__(self, devices, max_queue_size=8, concurrency=1):
+        self.workers = [DeviceWorker(device, max_queue_size, concurrency) for device in devices]
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, affinity=None, **kwargs):
+        # affinity, a hash, picks a preferred worker so calls for the same key land on the same
+        # device while its queue has room
+        with self.lock:
+            workers = sorted(self.workers, key=lambda w: w.pending())
+            if affinity is not None:
+                preferred = self.workers[affinity % len(self.workers)]
+                workers = [preferred] + [w for w in workers if w is not preferred]
+            for worker in workers:
+                try:
+                    return worker.submit(fn, *args, **kwargs)
+                except queue.Full:
+                    continue
+        raise QueueFull(self.retry_after())
+
+    def retry_after(self):
+        # Time for the least loaded worker to drain its queue, in whole seconds
+        estimate = min((w.pending() * w.mean_service_time() for w in self.workers), default=1)
+        return max(1, int(round(estimate)))
+
+    def stats(self):
+        return {str(worker.device): worker.stats() for worker in self.workers}
+
+
+def cpu_worker_main(conn, estimator_factory, num_threads):
+    import torch
+    torch.set_num_threads(num_threads)
+    metrics.forward = []
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        method, args, kwargs = message
+        try:
+            result = getattr(estimator_factory(), method)(*args, **kwargs)
+            timer = kwargs.get('timer')
+            conn.send((True, result, timer.timings if timer is not None else None, metrics.take_forwarded()))
+        except Exception as e:
+            conn.send((False, repr(e), None, metrics.take_forwarded()))
+
+
+class CPUWorkerProcess:
+    # A forked process that runs estimator methods on models loaded by the parent. Weights are
+    # read-only and live in shared memory, so every worker uses the same copy. A worker that dies
+    # fails the call it was running and is forked again for the next one.
+    def __init__(self, name, estimator_factory, num_threads):
+        self.name = name
+        self.estimator_factory = estimator_factory
+        self.num_threads = num_threads
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=cpu_worker_main,
+                                       args=(child_conn, self.estimator_factory, self.num_threads),
+                                       name=self.name, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def _restart(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.restarts += 1
+        self._start()
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            if not self.process.is_alive():
+                self._restart()
+            try:
+                self.conn.send((method, args, kwargs))
+                ok, result, timings, observations = self.conn.recv()
+            except (EOFError, OSError) as e:
+                exitcode = self.process.exitcode
+                self._restart()
+                raise RuntimeError(f'{self.name} died with exit code {exitcode} and was restarted') from e
+        # Stage histograms live in the parent, the one /metrics reads
+        metrics.replay(observations)
+        if not ok:
+            raise RuntimeError(f'{self.name} failed: {result}')
+        if timings is not None:
+            kwargs['timer'].timings.update(timings)
+        return result
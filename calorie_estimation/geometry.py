@@ -0,0 +1,111 @@
+import numpy as np
+
+COIN_NAME = 'coin'
+COIN_TO_PLATE = 25  # Adjust this value as needed
+
+
+class InstanceGeometry:
+    # Per-instance reductions over a set of masks, each read only inside its detection box grown by
+    # `margin` pixels, the crop segmentation.predict_box_masks cut the mask to. The pixels of every
+    # instance are gathered from its crop once, as flat image indices with the instance as label,
+    # and reduced with np.bincount, so the cost scales with the box areas instead of instances x
+    # image size. Pixels where masks overlap count for each instance,
+    # as when reducing every mask on its own.
+    def __init__(self, masks, boxes=None, margin=0):
+        masks = np.asarray(masks, dtype=bool)
+        self.count, self.height, self.width = masks.shape
+        indices = []
+        for i, mask in enumerate(masks):
+            y0, x0, y1, x1 = self.crop(boxes[i], margin) if boxes is not None else (0, 0, self.height, self.width)
+            rows, cols = np.nonzero(mask[y0:y1, x0:x1])
+            indices.append((rows + y0) * self.width + cols + x0)
+        sizes = [len(i) for i in indices]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+        self.indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        self.labels = np.repeat(np.arange(self.count), sizes)
+
+    def crop(self, box, margin):
+        # (y0, x0, y1, x1) of an [x0, y0, x1, y1] box, grown and clipped to the image like
+        # depth_to_pointcloud.roi_mask
+        x0, y0, x1, y1 = (int(v) for v in box)
+        return (max(0, y0 - margin), max(0, x0 - margin),
+                min(self.height, y1 + margin + 1), min(self.width, x1 + margin + 1))
+
+    def sum(self, weights=None):
+        # Sum of weights, a flat per-pixel array, or the pixel count per instance
+        weights = weights[self.indices] if weights is not None else None
+        return np.bincount(self.labels, weights=weights, minlength=self.count).astype(np.float64)
+
+    def centroid(self, instance_id):
+        # (row, col) mean of one instance, NaN for an empty mask
+        rows, cols = np.divmod(self.indices[self.offsets[instance_id]:self.offsets[instance_id + 1]], self.width)
+        if rows.size == 0:
+            return np.nan, np.nan
+        return rows.mean(), cols.mean()
+
+    def volumes(self, depth_map, reference_depth, offset=COIN_TO_PLATE):
+        # Integrated food height below the reference plane, per instance, in pixel units
+        depth = np.asarray(depth_map, dtype=np.float64).ravel()[self.indices]
+        heights = np.where(depth != 0, np.maximum(0, reference_depth - depth - offset), 0)
+        return np.bincount(self.labels, weights=heights, minlength=self.count)
+
+
+def build_segmentation(bounding_boxes, masks, areas, real_coin_area, margin=0):
+    # Collects SAM masks per detected instance, keyed by position instead of class name so two
+    # items of the same class stay separate. The most confident coin sets the pixel scale.
+    # margin is the one the masks were cut to their boxes with, see predict_box_masks.
+    instances = []
+    coin_id = None
+    confidence = 0
+    for instance_id, (obj, area) in enumerate(zip(bounding_boxes, areas)):
+        area = int(area)
+        instances.append({'instance_id': instance_id, 'name': obj['name'], 'object_id': obj['class'],
+                          'image_area': area})
+        if obj['name'] == COIN_NAME and float(obj['confidence']) > confidence:
+            coin_id = instance_id
+            confidence = float(obj['confidence'])
+
+    scale_factor = None
+    if coin_id is not None and instances[coin_id]['image_area']:
+        scale_factor = real_coin_area / instances[coin_id]['image_area']
+        for instance in instances:
+            if instance['name'] != COIN_NAME:
+                instance['real_life_area'] = scale_factor * instance['image_area']
+
+    return {'masks': masks, 'boxes': [obj['bbox'] for obj in bounding_boxes], 'margin': margin,
+            'instances': instances, 'coin_id': coin_id, 'scale_factor': scale_factor}
+
+
+def depth_roi_boxes(detected_objects):
+    # Boxes covering every depth pixel regression_features reads: the masks lie inside the detected
+    # boxes, and the coin's depth is looked up at its centroid indexed as [x, y], inside the coin
+    # box with its axes swapped
+    boxes = [obj['bbox'] for obj in detected_objects]
+    boxes += [[y0, x0, y1, x1] for x0, y0, x1, y1 in
+              (obj['bbox'] for obj in detected_objects if obj['name'] == COIN_NAME)]
+    return boxes
+
+
+def regression_features(segmentation, depth_map):
+    # Object id, area and volume of every food instance, the inputs of the mass regression,
+    # as a dict of columns. depth_map is in centimeters.
+    if segmentation['scale_factor'] is None:
+        raise ValueError('No coin was segmented, it is needed as the size reference')
+
+    foods = [instance for instance in segmentation['instances'] if instance['name'] != COIN_NAME]
+    features = {'object_id': [food['object_id'] for food in foods],
+                'area': [food['real_life_area'] for food in foods],
+                'volume': []}
+    if not foods:
+        return foods, features
+
+    geometry = InstanceGeometry(segmentation['masks'], segmentation.get('boxes'), segmentation.get('margin', 0))
+    row, col = geometry.centroid(segmentation['coin_id'])
+    if np.isnan(row):
+        volumes = np.zeros(geometry.count)
+    else:
+        # Indexed as [x, y] like the depth lookup the regression model was fitted with
+        cam_plane_to_coin = depth_map[int(col), int(row)]
+        volumes = geometry.volumes(depth_map, cam_plane_to_coin) * segmentation['scale_factor']
+    features['volume'] = [volumes[food['instance_id']] for food in foods]
+    return foods, features
@@ -0,0 +1,59 @@
+import io
+import hashlib
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_SIZE = (640, 640)
+
+
+class ImageFrame:
+    # A decoded image carried through the whole pipeline: the RGB uint8 array plus lazily
+    # created float tensors per device. Encoded bytes are only produced on request.
+    def __init__(self, array):
+        self.array = np.ascontiguousarray(array)
+        self.tensors = {}
+        self._digest = None
+
+    @classmethod
+    def from_bytes(cls, image_bytes, size=IMAGE_SIZE):
+        # Decode an upload and resize it to the model input size, None keeps the original size
+        with io.BytesIO(image_bytes) as img_buffer:
+            with Image.open(img_buffer) as img:
+                if size is not None:
+                    img = img.resize(size, 1)
+                return cls(np.array(img.convert('RGB')))
+
+    @property
+    def height(self):
+        return self.array.shape[0]
+
+    @property
+    def width(self):
+        return self.array.shape[1]
+
+    def tensor(self, device='cpu'):
+        # (1, 3, H, W) float tensor in [0, 1], as transforms.ToTensor() would produce. The uint8
+        # array is copied to the device before conversion, a quarter of the float transfer.
+        key = str(torch.device(device))
+        if key not in self.tensors:
+            image = torch.from_numpy(self.array).to(device)
+            self.tensors[key] = image.permute(2, 0, 1).unsqueeze(0).float().div(255)
+        return self.tensors[key]
+
+    def digest(self):
+        if self._digest is None:
+            digest = hashlib.sha256(str(self.array.shape).encode())
+            digest.update(self.array.data)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def to_bytes(self, format='PNG'):
+        output_buffer = io.BytesIO()
+        Image.fromarray(self.array).save(output_buffer, format=format)
+        return output_buffer.getvalue()
+
+    def __getstate__(self):
+        # Device tensors are not sent to worker processes, they are recreated there on use
+        return {'array': self.array, 'tensors': {}, '_digest': self._digest}
@@ -0,0 +1,229 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+# Column order of the rows passed to predict, the order regression_features produces
+FEATURE_NAMES = ['object_id', 'area', 'volume']
+
+
+def feature_order(estimator):
+    # Column permutation from FEATURE_NAMES to the order the estimator was fitted with
+    names = list(getattr(estimator, 'feature_names_in_', FEATURE_NAMES))
+    return np.array([FEATURE_NAMES.index(name) for name in names])
+
+
+class LinearRegressor:
+    kind = 'linear'
+
+    def __init__(self, coef, intercept):
+        self.coef = np.asarray(coef, dtype=np.float64).ravel()
+        self.intercept = float(np.ravel(intercept)[0])
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        return cls(estimator.coef_, estimator.intercept_)
+
+    def predict(self, X):
+        return X @ self.coef + self.intercept
+
+    def arrays(self):
+        return {'coef': self.coef, 'intercept': np.array([self.intercept])}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['coef'], arrays['intercept'])
+
+
+class TreeEnsembleRegressor:
+    # Every tree of a forest or boosting ensemble packed into padded (trees, nodes) arrays and
+    # evaluated level by level for all rows and trees at once.
+    kind = 'trees'
+
+    def __init__(self, feature, threshold, left, right, value, depth, scale, offset):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.depth = int(depth)
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        name = type(estimator).__name__
+        if name in ('DecisionTreeRegressor', 'ExtraTreeRegressor'):
+            trees, scale, offset = [estimator], 1.0, 0.0
+        elif name in ('RandomForestRegressor', 'ExtraTreesRegressor'):
+            trees = estimator.estimators_
+            scale, offset = 1.0 / len(trees), 0.0
+        elif name == 'GradientBoostingRegressor':
+            trees = list(estimator.estimators_.ravel())
+            scale = estimator.learning_rate
+            if estimator.init_ == 'zero':
+                offset = 0.0
+            elif type(estimator.init_).__name__ == 'DummyRegressor':
+                offset = float(np.ravel(estimator.init_.constant_)[0])
+            else:
+                raise TypeError(f'Unsupported init estimator {estimator.init_!r}')
+        else:
+            raise TypeError(f'Unsupported estimator {name}')
+
+        nodes = max(tree.tree_.node_count for tree in trees)
+        shape = (len(trees), nodes)
+        feature = np.zeros(shape, dtype=np.int64)
+        threshold = np.zeros(shape, dtype=np.float64)
+        left = np.full(shape, -1, dtype=np.int64)
+        right = np.full(shape, -1, dtype=np.int64)
+        value = np.zeros(shape, dtype=np.float64)
+        for i, tree in enumerate(trees):
+            t = tree.tree_
+            n = t.node_count
+            feature[i, :n] = np.maximum(t.feature, 0)
+            threshold[i, :n] = t.threshold
+            left[i, :n] = t.children_left
+            right[i, :n] = t.children_right
+            value[i, :n] = t.value[:, 0, 0]
+        depth = max(tree.tree_.max_depth for tree in trees)
+        return cls(feature, threshold, left, right, value, depth, scale, offset)
+
+    def predict(self, X):
+        # sklearn compares float32 features against the thresholds
+        X = X.astype(np.float32)
+        trees = np.arange(self.feature.shape[0])[:, None]
+        rows = np.arange(X.shape[0])[None, :]
+        node = np.zeros((self.feature.shape[0], X.shape[0]), dtype=np.int64)
+        for _ in range(self.depth):
+            leaf = self.left[trees, node] < 0
+            go_left = X[rows, self.feature[trees, node]] <= self.threshold[trees, node]
+            child = np.where(go_left, self.left[trees, node], self.right[trees, node])
+            node = np.where(leaf, node, child)
+        return self.offset + self.scale * self.value[trees, node].sum(axis=0)
+
+    def arrays(self):
+        return {'feature': self.feature, 'threshold': self.threshold, 'left': self.left, 'right': self.right,
+                'value': self.value, 'depth': np.array([self.depth]), 'scale': np.array([self.scale]),
+                'offset': np.array([self.offset])}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'], arrays['value'],
+                   arrays['depth'][0], arrays['scale'][0], arrays['offset'][0])
+
+
+REGRESSOR_KINDS = {regressor.kind: regressor for regressor in (LinearRegressor, TreeEnsembleRegressor)}
+LINEAR_ESTIMATORS = ('LinearRegression', 'Ridge', 'Lasso', 'ElasticNet', 'BayesianRidge', 'HuberRegressor')
+
+
+class ArrayRegressor:
+    # The mass regression as plain numpy arrays. Takes (n, 3) float rows in FEATURE_NAMES order,
+    # without pandas DataFrames or sklearn input validation.
+    def __init__(self, regressor, order):
+        self.regressor = regressor
+        self.order = np.asarray(order)
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        if type(estimator).__name__ in LINEAR_ESTIMATORS:
+            regressor = LinearRegressor.from_estimator(estimator)
+        else:
+            regressor = TreeEnsembleRegressor.from_estimator(estimator)
+        return cls(regressor, feature_order(estimator))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        kind = str(arrays.pop('kind')[0])
+        order = arrays.pop('order')
+        return cls(REGRESSOR_KINDS[kind].from_arrays(arrays), order)
+
+    def save(self, path):
+        np.savez(path, kind=np.array([self.regressor.kind]), order=self.order, **self.regressor.arrays())
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return self.regressor.predict(X[:, self.order])
+
+
+class EstimatorRegressor:
+    # Fallback for estimators that can't be exported, still fed numpy rows instead of DataFrames
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.order = feature_order(estimator)
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return np.asarray(self.estimator.predict(X[:, self.order]), dtype=np.float64)
+
+
+def to_array_regressor(estimator):
+    try:
+        return ArrayRegressor.from_estimator(estimator)
+    except (TypeError, AttributeError):
+        return EstimatorRegressor(estimator)
+
+
+class MassPredictor:
+    # Runs the mass regression for concurrent requests in shared batches. The worker takes
+    # whatever rows are queued when it wakes up, waiting up to max_wait_ms for more, so an idle
+    # server predicts immediately and a busy one amortizes the call over many requests.
+    def __init__(self, regressor, max_batch_rows=256, max_wait_ms=0):
+        self.regressor = regressor
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.rows = 0
+        self.worker = threading.Thread(target=self._run, name='mass-predictor', daemon=True)
+        self.worker.start()
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64).reshape(-1, len(FEATURE_NAMES))
+        if X.shape[0] == 0:
+            return np.zeros(0)
+        future = Future()
+        self.queue.put((X, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        rows = batch[0][0].shape[0]
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_rows:
+            try:
+                timeout = deadline - time.monotonic()
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += item[0].shape[0]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                pred = self.regressor.predict(np.concatenate([X for X, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            start = 0
+            for X, future in batch:
+                self.rows += X.shape[0]
+                future.set_result(pred[start:start + X.shape[0]])
+                start += X.shape[0]
+
+    def stats(self):
+        return {
+            'backend': type(self.regressor).__name__,
+            'queue_depth': self.queue.qsize(),
+            'batches': self.batches,
+            'rows': self.rows,
+            'mean_batch_rows': self.rows / self.batches if self.batches else 0.0,
+        }
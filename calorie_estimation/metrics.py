@@ -0,0 +1,150 @@
+import time
+import bisect
+import threading
+import functools
+
+import torch
+
+# Upper bounds of the stage latency histogram buckets, in milliseconds
+STAGE_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    def __init__(self, buckets=STAGE_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Metrics:
+    # Process-wide latency histograms per pipeline stage, plus gauges sampled from collectors
+    # when /metrics is scraped, rendered in the Prometheus text format.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.collectors = []
+        self.forward = None  # Set in CPU worker processes, observations are sent back to the parent
+
+    def observe(self, stage, ms, device=''):
+        with self.lock:
+            key = (stage, str(device))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(ms)
+            if self.forward is not None:
+                self.forward.append((stage, ms, str(device)))
+
+    def replay(self, observations):
+        for stage, ms, device in observations:
+            self.observe(stage, ms, device)
+
+    def take_forwarded(self):
+        with self.lock:
+            observations, self.forward = self.forward, []
+        return observations
+
+    def add_collector(self, collector):
+        # collector() returns (name, help, [(labels, value), ...]) gauge families
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = ['# HELP calorie_stage_duration_ms Time spent in each pipeline stage, nested stages excluded',
+                 '# TYPE calorie_stage_duration_ms histogram']
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for (stage, device), histogram in histograms:
+                labels = {'stage': stage, 'device': device}
+                for bound, count in histogram.cumulative():
+                    lines.append(f'calorie_stage_duration_ms_bucket{format_labels({**labels, "le": bound})} {count}')
+                lines.append(f'calorie_stage_duration_ms_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'calorie_stage_duration_ms_count{format_labels(labels)} {histogram.count}')
+
+        for collector in self.collectors:
+            for name, help, samples in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(labels)} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def gpu_memory_samples():
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return []
+    devices = [torch.device('cuda', i) for i in range(torch.cuda.device_count())]
+    return [
+        ('calorie_gpu_memory_allocated_bytes', 'Memory currently allocated by tensors per GPU',
+         [({'device': str(d)}, torch.cuda.memory_allocated(d)) for d in devices]),
+        ('calorie_gpu_memory_max_allocated_bytes', 'High-water mark of memory allocated by tensors per GPU',
+         [({'device': str(d)}, torch.cuda.max_memory_allocated(d)) for d in devices]),
+        ('calorie_gpu_memory_max_reserved_bytes', 'High-water mark of memory reserved by the caching allocator per GPU',
+         [({'device': str(d)}, torch.cuda.max_memory_reserved(d)) for d in devices]),
+    ]
+
+
+metrics = Metrics()
+metrics.add_collector(gpu_memory_samples)
+
+# Per-thread stack of open stages, so a stage that calls another one only counts its own time
+_active = threading.local()
+
+
+def synchronize(device):
+    # Waits for work queued on the current stream, so GPU time is charged to the stage that queued it
+    if device is not None and torch.device(device).type == 'cuda':
+        with torch.cuda.device(device):
+            torch.cuda.current_stream().synchronize()
+
+
+def timed(fn, stage, device=None, method=False):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        stage_device = getattr(args[0], 'device', None) if method else device
+        stack = getattr(_active, 'stack', None)
+        if stack is None:
+            stack = _active.stack = []
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            synchronize(stage_device)
+            elapsed = 1000 * (time.perf_counter() - started)
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            metrics.observe(stage, elapsed - nested, stage_device if stage_device is not None else '')
+    return wrapper
+
+
+def instrument(target, stages, device=None):
+    # Wraps the functions of a module, or the methods of a class, named in stages
+    # ({attribute: stage name}) so each call is recorded in the stage histograms.
+    # Methods take the device from the instance, module functions use the given device.
+    method = isinstance(target, type)
+    for attribute, stage in stages.items():
+        setattr(target, attribute, timed(getattr(target, attribute), stage, device, method))
+    return target
+
+
+def server_timing(timings):
+    # Server-Timing header value from StageTimer timings
+    return ', '.join(f'{name};dur={ms:.1f}' for name, ms in timings.items())
@@ -0,0 +1,127 @@
+import os
+import time
+import threading
+
+import torch
+import joblib
+
+from segment_anything import sam_model_registry
+from mass_predictor import ArrayRegressor, to_array_regressor
+from precision import apply_precision
+
+# Constants
+SAM_CHECKPOINT_PATH = "./data/models/sam_vit_h_4b8939.pth"
+SAM_MODEL_TYPE = "vit_h"
+YOLO_CHECKPOINT_PATH = './data/models/yolo.pt'
+REGRESSION_MODEL_PATH = './data/models/regression_model.pkl'
+REGRESSION_ARRAYS_PATH = './data/models/regression_model.npz'  # Written by tools/export_regression_model.py
+
+# Random-weight stand-ins from stub_models.py instead of the real checkpoints, for benchmarks and CI
+STUB_MODELS = os.environ.get('CALORIE_STUB_MODELS', '0') == '1'
+
+# Consolidated checkpoints written by tools/convert_checkpoints.py, used instead of the originals when present
+CONSOLIDATED_DIR = os.environ.get('CONSOLIDATED_CHECKPOINT_DIR', './data/models/consolidated')
+
+
+def consolidated_path(name):
+    if not CONSOLIDATED_DIR:
+        return None
+    path = os.path.join(CONSOLIDATED_DIR, f'{name}.pt')
+    return path if os.path.exists(path) else None
+
+
+def load_consolidated_state_dict(path):
+    # Memory-mapped, so tensors are paged in on use and shared through the page cache
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)['model']
+
+
+def load_sam_model(device):
+    path = consolidated_path('sam_model')
+    if path is None:
+        return sam_model_registry[SAM_MODEL_TYPE](checkpoint=SAM_CHECKPOINT_PATH).to(device=device)
+    sam_model = sam_model_registry[SAM_MODEL_TYPE](checkpoint=None)
+    sam_model.load_state_dict(load_consolidated_state_dict(path), assign=True)
+    return sam_model.to(device=device)
+
+
+def load_depth_model(device):
+    # Depth-Anything's directory must already be on sys.path, see async_utility.py
+    from depth_to_pointcloud import get_depth_model
+    path = consolidated_path('depth_model')
+    if path is None:
+        return get_depth_model(device)
+    # A full checkpoint is given, so the Depth-Anything base weights are not loaded first
+    return get_depth_model(device, f'mmap::{path}')
+
+
+def load_yolo_model(device):
+    yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path=YOLO_CHECKPOINT_PATH, device=device)
+    yolo_model.eval()
+    return yolo_model
+
+
+def load_regression_model(device=None):
+    # The regression model runs on the CPU, so one copy serves every device. It is used in
+    # array-backed form and takes numpy rows in mass_predictor.FEATURE_NAMES order.
+    if os.path.exists(REGRESSION_ARRAYS_PATH):
+        return ArrayRegressor.load(REGRESSION_ARRAYS_PATH)
+    return to_array_regressor(joblib.load(REGRESSION_MODEL_PATH))
+
+
+class ModelRegistry:
+    # Process-wide registry that loads each model at most once per device, either lazily on
+    # first use or eagerly through preload(). utility.py and async_utility.ModelManager share it.
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.models = {}
+        self.load_times = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def key(self, name, device):
+        if name == 'regression_model':
+            return name, None
+        return name, str(torch.device(device))
+
+    def get(self, name, device=None):
+        key = self.key(name, device)
+        model = self.models.get(key)
+        if model is not None:
+            return model
+
+        # Hold a per-model lock so concurrent first requests load it only once
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.models:
+                started = time.perf_counter()
+                # Precision is set per model through SAM_PRECISION, DEPTH_PRECISION and YOLO_PRECISION
+                self.models[key] = apply_precision(name, self.loaders[name](device), device)
+                self.load_times[key] = time.perf_counter() - started
+        return self.models[key]
+
+    def preload(self, devices, names=None):
+        for device in devices:
+            for name in names or self.loaders:
+                self.get(name, device)
+
+    def get_load_times(self):
+        return {f'{name}@{device}' if device else name: seconds for (name, device), seconds in self.load_times.items()}
+
+
+def stub_loaders():
+    import stub_models
+    return {
+        'sam_model': stub_models.build_stub_sam,
+        'depth_model': stub_models.build_stub_depth,
+        'yolo_model': stub_models.build_stub_yolo,
+        'regression_model': stub_models.build_stub_regression,
+    }
+
+
+model_registry = ModelRegistry(stub_loaders() if STUB_MODELS else {
+    'sam_model': load_sam_model,
+    'depth_model': load_depth_model,
+    'yolo_model': load_yolo_model,
+    'regression_model': load_regression_model,
+})
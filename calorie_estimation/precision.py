@@ -0,0 +1,116 @@
+import os
+import functools
+from contextlib import nullcontext
+
+import torch
+
+# Precision per model, one of:
+#   fp32       - unchanged
+#   fp16, bf16 - fp32 weights, forwards run under autocast
+#   fp16-cast, bf16-cast - weights cast to half precision as well, halving their memory
+PRECISIONS = ('fp32', 'fp16', 'bf16', 'fp16-cast', 'bf16-cast')
+MODEL_PRECISION = {
+    'sam_model': os.environ.get('SAM_PRECISION', 'fp32'),
+    'depth_model': os.environ.get('DEPTH_PRECISION', 'fp32'),
+    'yolo_model': os.environ.get('YOLO_PRECISION', 'fp32'),
+}
+
+# Submodules the forward is wrapped at. SamPredictor calls SAM's parts directly, not Sam.forward.
+ENTRY_POINTS = {
+    'sam_model': ('image_encoder', 'prompt_encoder', 'mask_decoder'),
+    'depth_model': ('',),
+    'yolo_model': ('',),
+}
+
+# Submodules kept in fp32 with autocast disabled: ZoeDepth's bin distribution and attractor
+# math takes logs and ratios of small numbers, which lose too much in half precision. SAM's
+# random Fourier positional encoding is called outside the wrapped entry points, by
+# SamPredictor through get_dense_pe() and by ScaledSamPredictor through pe_layer(grid), with
+# an fp32 coordinate grid that its buffer must match.
+FP32_MODULES = {
+    'sam_model': ('PositionEmbeddingRandom',),
+    'depth_model': ('ConditionalLogBinomial', 'AttractorLayer', 'AttractorLayerUnnormed'),
+}
+
+
+def precision_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision!r}, expected one of {PRECISIONS}')
+    return {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision.split('-')[0]]
+
+
+def autocast(device, precision):
+    dtype = precision_dtype(precision)
+    if dtype == torch.float32:
+        return nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+def map_tensors(value, fn):
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, dict):
+        return {key: map_tensors(item, fn) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(map_tensors(item, fn) for item in value)
+    return value
+
+
+def to_fp32(tensor):
+    return tensor.float() if tensor.is_floating_point() else tensor
+
+
+def run_under_autocast(module, device, precision):
+    # Outputs go back to fp32, so code after the model (mask thresholds, depth resizing, the
+    # regression features) sees the same dtypes as before
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with autocast(device, precision):
+            return map_tensors(forward(*args, **kwargs), to_fp32)
+    module.forward = wrapper
+
+
+def run_in_fp32(module, device):
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with torch.autocast(torch.device(device).type, enabled=False):
+            return forward(*map_tensors(args, to_fp32), **map_tensors(kwargs, to_fp32))
+    module.forward = wrapper
+
+
+def protect_fp32_modules(name, model, device):
+    # Keeps the FP32_MODULES of the model in fp32 under any outer autocast, e.g. a quality tier's
+    for submodule in model.modules():
+        if type(submodule).__name__ in FP32_MODULES.get(name, ()) and not getattr(submodule, 'runs_in_fp32', False):
+            submodule.float()
+            run_in_fp32(submodule, device)
+            submodule.runs_in_fp32 = True
+    return model
+
+
+def apply_precision(name, model, device, precision=None):
+    # Sets up the model loaded for `name` to run in its configured precision
+    precision = precision or MODEL_PRECISION.get(name, 'fp32')
+    dtype = precision_dtype(precision)
+    if dtype == torch.float32:
+        return model
+
+    cast = precision.endswith('-cast')
+    if hasattr(model, 'amp') and not cast:
+        # YOLOv5's AutoShape runs its own fp16 autocast on CUDA and disables any outer one
+        if dtype != torch.float16:
+            raise ValueError(f'{name} supports fp16 autocast only, use {precision}-cast for {precision}')
+        model.amp = True
+        return model
+
+    if cast:
+        # AutoShape casts its input to the weights' dtype itself
+        model.to(dtype=dtype)
+    protect_fp32_modules(name, model, device)
+    for entry_point in ENTRY_POINTS.get(name, ('',)):
+        run_under_autocast(model.get_submodule(entry_point), device, precision)
+    return model
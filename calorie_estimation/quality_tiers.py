@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import torch
+
+# Named quality tiers, most accurate first. Every tier sets
+#   sam_size   - side of the square the SAM image encoder runs at, 1024 is SAM's native resolution
+#   depth_size - [height, width] ZoeDepth resizes its input to, multiples of 14 about 0.8x and
+#                0.65x of the model's configured 392 x 518 so its aspect ratio is kept, null keeps
+#                the configured size
+#   precision  - autocast for the SAM encoder and ZoeDepth: fp32, fp16 or bf16. fp32 leaves the
+#                models in the precision set by SAM_PRECISION and DEPTH_PRECISION
+HALF = 'fp16' if torch.cuda.is_available() else 'bf16'
+DEFAULT_TIERS = {
+    'full': {'sam_size': 1024, 'depth_size': None, 'precision': 'fp32'},
+    'balanced': {'sam_size': 768, 'depth_size': (308, 420), 'precision': HALF},
+    'fast': {'sam_size': 512, 'depth_size': (252, 336), 'precision': HALF},
+}
+QUALITY_TIERS = json.loads(os.environ['QUALITY_TIERS']) if os.environ.get('QUALITY_TIERS') else DEFAULT_TIERS
+QUALITY_TIER = os.environ.get('QUALITY_TIER', 'auto')  # 'auto', or the tier every request runs at
+QUALITY_SLO_MS = float(os.environ.get('QUALITY_SLO_MS', 3000))  # p95 latency target
+# Requests in flight at which auto selection steps down to the second, third, ... tier
+QUALITY_QUEUE_LIMITS = [int(n) for n in os.environ.get('QUALITY_QUEUE_LIMITS', '4,8').split(',') if n]
+QUALITY_COOLDOWN = float(os.environ.get('QUALITY_COOLDOWN', 10))  # Seconds before stepping back up a tier
+
+BEST_TIER = next(iter(QUALITY_TIERS))
+
+for name, tier in QUALITY_TIERS.items():
+    missing = {'sam_size', 'depth_size', 'precision'} - set(tier)
+    if missing:
+        raise ValueError(f'Quality tier {name!r} is missing {sorted(missing)}')
+    if tier['depth_size'] is not None:
+        # A tuple, as JSON gives a list, since the size keys the depth batches and compiled variants
+        tier['depth_size'] = tuple(tier['depth_size'])
+        if len(tier['depth_size']) != 2 or any(side % 14 for side in tier['depth_size']):
+            raise ValueError(f'Quality tier {name!r} depth_size must be [height, width] in multiples of 14')
+if QUALITY_TIER != 'auto' and QUALITY_TIER not in QUALITY_TIERS:
+    raise ValueError(f'QUALITY_TIER {QUALITY_TIER!r} is not one of {list(QUALITY_TIERS)}')
+
+
+def autocast_dtype(tier):
+    # dtype the tier's forwards run under autocast at, None for fp32
+    return {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[QUALITY_TIERS[tier]['precision']]
+
+
+def uses_reduced_precision():
+    return any(tier['precision'] != 'fp32' for tier in QUALITY_TIERS.values())
+
+
+class TierSelector:
+    # Picks the tier of each request. Automatic selection steps down one tier for every queue
+    # limit the requests in flight (queued or running) have reached, and one more while the p95
+    # latency of recent requests is over the SLO. It steps back up only after `cooldown` seconds
+    # at the lower tier, so the tier doesn't flap as the lower tier's latencies come in.
+    def __init__(self, tiers, mode='auto', slo_ms=3000, queue_limits=(4, 8), cooldown=10, window=128):
+        self.names = list(tiers)
+        self.mode = mode
+        self.slo_ms = slo_ms
+        self.queue_limits = list(queue_limits)
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.in_flight = 0
+        self.level = 0
+        self.changed = time.monotonic()
+        self.switches = 0
+        self.requests = Counter()
+
+    def p95_ms(self):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+
+    def _auto(self):
+        level = sum(self.in_flight >= limit for limit in self.queue_limits)
+        if self.p95_ms() > self.slo_ms:
+            level += 1
+        level = min(level, len(self.names) - 1)
+        now = time.monotonic()
+        if level < self.level and now - self.changed < self.cooldown:
+            level = self.level
+        if level != self.level:
+            self.level = level
+            self.changed = now
+            self.switches += 1
+        return self.names[level]
+
+    @contextmanager
+    def request(self, forced=None, timer=None):
+        # Tier for one request, counted as in flight until the block exits. forced is a tier
+        # name asked for by the client and wins over the configured mode. The latency counts
+        # toward the p95 only when the block completes and `timer`, the request's StageTimer,
+        # timed a depth stage: result cache hits and rejected or failed requests are fast
+        # without the server having capacity to spare.
+        if forced is not None and forced not in self.names:
+            raise ValueError(f'Unknown quality tier {forced!r}, expected one of {self.names}')
+        with self.lock:
+            self.in_flight += 1
+            if forced is not None:
+                tier = forced
+            else:
+                tier = self._auto() if self.mode == 'auto' else self.mode
+            self.requests[tier] += 1
+        started = time.perf_counter()
+        completed = False
+        try:
+            yield tier
+            completed = True
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                if completed and timer is not None and 'depth' in timer.timings:
+                    self.latencies.append(1000 * (time.perf_counter() - started))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'tier': self.names[self.level],
+                'in_flight': self.in_flight,
+                'p95_ms': self.p95_ms(),
+                'slo_ms': self.slo_ms,
+                'switches': self.switches,
+                'requests': dict(self.requests),
+            }
+
+    def metric_samples(self):
+        stats = self.stats()
+        return [
+            ('calorie_quality_tier_level', 'Index of the automatically selected quality tier, 0 is the most accurate',
+             [({}, self.names.index(stats['tier']))]),
+            ('calorie_quality_tier_requests', 'Requests served per quality tier',
+             [({'tier': name}, stats['requests'].get(name, 0)) for name in self.names]),
+        ]
+
+
+tier_selector = TierSelector(QUALITY_TIERS, QUALITY_TIER, QUALITY_SLO_MS, QUALITY_QUEUE_LIMITS, QUALITY_COOLDOWN)
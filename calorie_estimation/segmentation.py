@@ -0,0 +1,113 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+from segment_anything import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+def box_regions(boxes, margin, size):
+    # (N, H, W) masks of the [x0, y0, x1, y1] boxes grown by margin, with the bounds of
+    # depth_to_pointcloud.roi_mask
+    boxes = boxes.long()
+    rows = torch.arange(size[0], device=boxes.device)[None]
+    cols = torch.arange(size[1], device=boxes.device)[None]
+    inside_rows = (rows >= boxes[:, 1:2] - margin) & (rows <= boxes[:, 3:4] + margin)
+    inside_cols = (cols >= boxes[:, 0:1] - margin) & (cols <= boxes[:, 2:3] + margin)
+    return inside_rows[:, :, None] & inside_cols[:, None, :]
+
+
+def predict_box_masks(mask_predictor, boxes, margin=None):
+    # Decode every box in one batched pass through SAM's mask decoder instead of one call per box.
+    # Expects set_image to have been called on the predictor. Returns host masks of shape
+    # (N, H, W) and per-object pixel areas. The areas are counted on the device and copied back with
+    # the masks in a single transfer, as bytes appended to the flattened masks. With a margin, each
+    # mask is cut to its box grown by margin pixels, the pixels geometry.InstanceGeometry reads.
+    height, width = mask_predictor.original_size
+    if len(boxes) == 0:
+        return np.zeros((0, height, width), dtype=bool), np.zeros(0, dtype=np.int64)
+
+    original_boxes = torch.as_tensor(np.asarray(boxes), dtype=torch.float, device=mask_predictor.device)
+    boxes = mask_predictor.transform.apply_boxes_torch(original_boxes, mask_predictor.original_size)
+    masks, _, _ = mask_predictor.predict_torch(point_coords=None, point_labels=None, boxes=boxes,
+                                               multimask_output=False)
+    masks = masks[:, 0]
+    if margin is not None:
+        masks = masks & box_regions(original_boxes, margin, (height, width))
+    areas = masks.sum(dim=(1, 2), dtype=torch.int32)
+    packed = torch.cat([masks.reshape(-1).view(torch.uint8), areas.view(torch.uint8)]).cpu().numpy()
+    count = masks.numel()
+    return (packed[:count].view(bool).reshape(masks.shape),
+            packed[count:].view(np.int32).astype(np.int64))
+
+
+def encode_image(encoder, x):
+    # SAM's ImageEncoderViT forward with the absolute position embedding resized to the token grid
+    # of x. The windowed blocks pad to their window, the global ones interpolate their relative
+    # position tables to the grid themselves.
+    x = encoder.patch_embed(x)
+    if encoder.pos_embed is not None:
+        pos_embed = encoder.pos_embed
+        if pos_embed.shape[1:3] != x.shape[1:3]:
+            pos_embed = F.interpolate(pos_embed.permute(0, 3, 1, 2), size=x.shape[1:3], mode='bicubic',
+                                      align_corners=False).permute(0, 2, 3, 1)
+        x = x + pos_embed
+    for block in encoder.blocks:
+        x = block(x)
+    return encoder.neck(x.permute(0, 3, 1, 2))
+
+
+class ScaledSamPredictor(SamPredictor):
+    # SamPredictor running the image encoder at image_size instead of SAM's native 1024, for the
+    # cheaper quality tiers: 768 has 0.56x and 512 0.25x the tokens. Prompts are encoded as for
+    # the native size, which gives the same fractions of the padded square, and the mask decoder
+    # gets the dense positional encoding of the smaller grid. The shared model is not modified,
+    # so predictors of every size can use one SAM at the same time. Box prompts only.
+    def __init__(self, sam_model, image_size):
+        super().__init__(sam_model)
+        self.image_size = image_size
+        self.transform = ResizeLongestSide(image_size)
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image, original_image_size):
+        self.reset_image()
+        self.original_size = original_image_size
+        self.input_size = tuple(transformed_image.shape[-2:])
+        x = (transformed_image - self.model.pixel_mean) / self.model.pixel_std
+        x = F.pad(x, (0, self.image_size - x.shape[-1], 0, self.image_size - x.shape[-2]))
+        self.features = encode_image(self.model.image_encoder, x)
+        self.is_image_set = True
+
+    @torch.no_grad()
+    def predict_torch(self, point_coords, point_labels, boxes=None, mask_input=None, multimask_output=True,
+                      return_logits=False):
+        if not self.is_image_set:
+            raise RuntimeError('An image must be set with .set_image(...) before mask prediction.')
+        if point_coords is not None or mask_input is not None:
+            raise NotImplementedError('ScaledSamPredictor only takes box prompts')
+
+        scale = self.model.image_encoder.img_size / self.image_size
+        sparse_embeddings, dense_embeddings = self.model.prompt_encoder(points=None, boxes=boxes * scale, masks=None)
+        # Without a mask prompt the dense embedding is the same vector at every position
+        grid = tuple(self.features.shape[-2:])
+        low_res_masks, iou_predictions = self.model.mask_decoder(
+            image_embeddings=self.features,
+            image_pe=self.model.prompt_encoder.pe_layer(grid).unsqueeze(0),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings[..., :grid[0], :grid[1]],
+            multimask_output=multimask_output,
+        )
+
+        masks = F.interpolate(low_res_masks, (self.image_size, self.image_size), mode='bilinear', align_corners=False)
+        masks = masks[..., :self.input_size[0], :self.input_size[1]]
+        masks = F.interpolate(masks, self.original_size, mode='bilinear', align_corners=False)
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+        return masks, iou_predictions, low_res_masks
+
+
+def sam_predictor(sam_model, image_size=None):
+    # Predictor encoding at image_size, SAM's own SamPredictor at the native resolution
+    native = sam_model.image_encoder.img_size
+    if image_size is None or image_size >= native:
+        return SamPredictor(sam_model)
+    return ScaledSamPredictor(sam_model, image_size)
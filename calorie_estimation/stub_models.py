@@ -0,0 +1,115 @@
+# Lightweight random-weight stand-ins for SAM, ZoeDepth, YOLOv5 and the mass regression.
+# They take and return tensors of the same shapes as the real models, so the whole pipeline
+# runs on a CPU-only machine without checkpoints or network access. Enabled with
+# CALORIE_STUB_MODELS=1, see model_registry.py; outputs are meaningless, timings are not.
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from segment_anything.modeling import Sam, ImageEncoderViT, PromptEncoder, MaskDecoder, TwoWayTransformer
+
+from mass_predictor import FEATURE_NAMES, ArrayRegressor, LinearRegressor
+
+SEED = 0
+
+# (class, name) of the stub detections, a coin first so the mass regression has its size reference
+STUB_CLASSES = [(0, 'coin'), (1, 'cabbage'), (2, 'fried potato'), (3, 'grilled pork')]
+
+
+def seeded(build):
+    # Same weights on every call without touching the global RNG state
+    def wrapper(*args, **kwargs):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(SEED)
+            return build(*args, **kwargs)
+    return wrapper
+
+
+@seeded
+def build_stub_sam(device):
+    # One narrow ViT block, but the real 1024x1024 input, 256x64x64 embedding and 256x256 mask logits
+    prompt_embed_dim = 256
+    image_size = 1024
+    patch_size = 16
+    embedding_size = image_size // patch_size
+    sam = Sam(
+        image_encoder=ImageEncoderViT(depth=1, embed_dim=32, img_size=image_size, mlp_ratio=1, num_heads=1,
+                                      patch_size=patch_size, qkv_bias=True, use_rel_pos=False, window_size=14,
+                                      out_chans=prompt_embed_dim, global_attn_indexes=()),
+        prompt_encoder=PromptEncoder(embed_dim=prompt_embed_dim, image_embedding_size=(embedding_size, embedding_size),
+                                     input_image_size=(image_size, image_size), mask_in_chans=16),
+        mask_decoder=MaskDecoder(num_multimask_outputs=3,
+                                 transformer=TwoWayTransformer(depth=1, embedding_dim=prompt_embed_dim, mlp_dim=256,
+                                                               num_heads=2),
+                                 transformer_dim=prompt_embed_dim, iou_head_depth=1, iou_head_hidden_dim=32),
+    )
+    return sam.eval().to(device=device)
+
+
+class StubDepthModel(nn.Module):
+    # Returns {'metric_depth': (B, 1, H/2, W/2)} in meters, like ZoeDepth's forward
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Conv2d(3, 16, kernel_size=3, stride=2, padding=1)
+        self.head = nn.Conv2d(16, 1, kernel_size=1)
+
+    def forward(self, x, dataset='nyu', **kwargs):
+        depth = 0.3 + 0.3 * torch.sigmoid(self.head(F.relu(self.encoder(x))))
+        return {'metric_depth': depth}
+
+
+@seeded
+def build_stub_depth(device):
+    return StubDepthModel().eval().to(device)
+
+
+class StubDetections:
+    # The part of a YOLOv5 Detections object the pipeline reads: results.pandas().xyxy[0]
+    def __init__(self, frame):
+        self.xyxy = [frame]
+
+    def pandas(self):
+        return self
+
+
+class StubYOLO(nn.Module):
+    # A small strided conv network over the 640x640 image. Each class is placed in a fixed
+    # quadrant, with a box size and confidence taken from the pooled activations.
+    def __init__(self):
+        super().__init__()
+        self.backbone = nn.Sequential(
+            nn.Conv2d(3, 16, kernel_size=3, stride=4, padding=1), nn.ReLU(),
+            nn.Conv2d(16, 32, kernel_size=3, stride=4, padding=1), nn.ReLU(),
+            nn.Conv2d(32, 2 * len(STUB_CLASSES), kernel_size=3, stride=2, padding=1),
+        )
+
+    @torch.no_grad()
+    def forward(self, image):
+        parameter = next(self.parameters())
+        x = torch.as_tensor(np.ascontiguousarray(image)).to(parameter.device)
+        x = x.permute(2, 0, 1).unsqueeze(0).float().div(255)
+        pooled = torch.sigmoid(self.backbone(x).mean(dim=(2, 3))).view(len(STUB_CLASSES), 2).cpu().numpy()
+
+        height, width = image.shape[:2]
+        rows = []
+        for i, ((class_id, name), (size, confidence)) in enumerate(zip(STUB_CLASSES, pooled)):
+            cx = width * (0.25 + 0.5 * (i % 2))
+            cy = height * (0.25 + 0.5 * (i // 2))
+            half = (0.08 + 0.12 * size) * min(width, height)
+            rows.append({'xmin': cx - half, 'ymin': cy - half, 'xmax': cx + half, 'ymax': cy + half,
+                         'confidence': 0.5 + 0.5 * float(confidence), 'class': class_id, 'name': name})
+        return StubDetections(pd.DataFrame(rows, columns=['xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class',
+                                                           'name']))
+
+
+@seeded
+def build_stub_yolo(device):
+    return StubYOLO().eval().to(device)
+
+
+def build_stub_regression(device=None):
+    # Mass grows with area and volume, like the fitted model
+    return ArrayRegressor(LinearRegressor([0.0, 0.2, 0.5], 5.0), np.arange(len(FEATURE_NAMES)))
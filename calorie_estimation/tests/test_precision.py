@@ -0,0 +1,38 @@
+# Box prediction through SAM with its weights cast to half precision, on the random-weight stand-in
+# from stub_models.py. Run from the calorie_estimation directory:
+#   python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('segment_anything')
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from precision import apply_precision
+from segmentation import predict_box_masks, sam_predictor
+from stub_models import build_stub_sam
+
+BOXES = [[40, 60, 200, 220], [300, 320, 600, 560]]
+
+
+@pytest.mark.parametrize('image_size', [None, 512])
+def test_cast_sam_predicts_boxes(image_size):
+    device = torch.device('cpu')
+    sam = apply_precision('sam_model', build_stub_sam(device), device, 'bf16-cast')
+    predictor = sam_predictor(sam, image_size)
+    image = np.random.default_rng(0).integers(0, 256, (640, 640, 3), dtype=np.uint8)
+
+    # As CalorieEstimator.set_sam_image: the scaled predictor runs the encoder's parts directly,
+    # past the wrapped forward, so it is encoded under autocast
+    with torch.autocast(device.type, dtype=torch.bfloat16):
+        predictor.set_image(image)
+    predictor.features = predictor.features.float()
+    masks, areas = predict_box_masks(predictor, BOXES)
+
+    assert masks.shape == (len(BOXES), 640, 640) and masks.dtype == bool
+    assert np.array_equal(areas, masks.sum(axis=(1, 2)))
@@ -0,0 +1,30 @@
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+class StageTimer:
+    # Records wall-clock time per pipeline stage in milliseconds. CUDA work is queued
+    # asynchronously, so the current stream is synchronized before a stage is closed. Only that
+    # stream: other requests' work on the device, the depth batcher's among it, is not waited for.
+    def __init__(self, device=None):
+        self.device = device
+        self.timings = {}
+
+    def synchronize(self):
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            with torch.cuda.device(self.device):
+                torch.cuda.current_stream().synchronize()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.timings[name] = self.timings.get(name, 0.0) + 1000 * (time.perf_counter() - started)
+
+    def total(self):
+        return sum(self.timings.values())
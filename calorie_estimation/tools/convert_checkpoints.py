@@ -0,0 +1,49 @@
+# Writes one consolidated, memory-mappable weight file per deployed model.
+# Run from the calorie_estimation directory:
+#   python tools/convert_checkpoints.py --models sam_model depth_model
+# model_registry picks the files up from CONSOLIDATED_CHECKPOINT_DIR on the next start.
+#
+# YOLOv5 is not converted: its checkpoint is a pickled module that torch.hub rebuilds itself,
+# and it is already a single small file.
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+import model_registry
+
+CONVERTIBLE_MODELS = ['sam_model', 'depth_model']
+
+
+def convert(name, out_dir):
+    started = time.perf_counter()
+    # Build from the original checkpoints, whatever is already in the output directory
+    model_registry.CONSOLIDATED_DIR = None
+    model = model_registry.model_registry.loaders[name]('cpu')
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+
+    path = os.path.join(out_dir, f'{name}.pt')
+    torch.save({'model': state_dict}, path)
+    size = os.path.getsize(path) / 1024 ** 2
+    print(f'{name}: wrote {path} ({size:.0f} MiB) in {time.perf_counter() - started:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consolidate model checkpoints into memory-mappable files')
+    parser.add_argument('--models', nargs='+', default=CONVERTIBLE_MODELS, choices=CONVERTIBLE_MODELS)
+    parser.add_argument('--out', type=str, default=model_registry.CONSOLIDATED_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for name in args.models:
+        convert(name, args.out)
+
+
+if __name__ == '__main__':
+    main()
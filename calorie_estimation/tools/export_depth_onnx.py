@@ -0,0 +1,77 @@
+# Exports the ZoeDepth model (nutrition5k checkpoint, nyu config) to ONNX at 640x640 with a
+# dynamic batch dimension, then checks ONNX Runtime against the PyTorch output. Run from the
+# calorie_estimation directory:
+#   python tools/export_depth_onnx.py
+# DEPTH_BACKEND=onnx then serves depth from the exported graph. Exits non-zero when the
+# outputs differ by more than --atol meters.
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath('./data/models/Depth-Anything/metric_depth'))
+
+from depth_to_pointcloud import (FINAL_HEIGHT, FINAL_WIDTH, ONNX_MODEL_PATH, PRETRAINED_RESOURCE, MetricDepthOutput,
+                                 OnnxDepthModel, load_depth_model)
+from image_frame import ImageFrame
+
+
+def export(model, path, opset):
+    started = time.perf_counter()
+    example = torch.rand(1, 3, FINAL_HEIGHT, FINAL_WIDTH)
+    with torch.no_grad():
+        torch.onnx.export(MetricDepthOutput(model), example, path, input_names=['image'],
+                          output_names=['metric_depth'], opset_version=opset, do_constant_folding=True,
+                          dynamic_axes={'image': {0: 'batch'}, 'metric_depth': {0: 'batch'}})
+    size = os.path.getsize(path) / 1024 ** 2
+    print(f'wrote {path} ({size:.0f} MiB) in {time.perf_counter() - started:.1f}s')
+
+
+def parity_inputs(image_dir, count):
+    # Random images at batch sizes 1 and 2, plus real photos when given
+    generator = torch.Generator().manual_seed(0)
+    inputs = [torch.rand(1 + i % 2, 3, FINAL_HEIGHT, FINAL_WIDTH, generator=generator) for i in range(count)]
+    if image_dir is not None:
+        for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+            with open(path, 'rb') as f:
+                inputs.append(ImageFrame.from_bytes(f.read()).tensor('cpu'))
+    return inputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the depth model to ONNX and check parity')
+    parser.add_argument('--checkpoint', type=str, default=PRETRAINED_RESOURCE)
+    parser.add_argument('--out', type=str, default=ONNX_MODEL_PATH)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--images', type=str, default=None, help='Photos added to the parity check')
+    parser.add_argument('--random', type=int, default=4, help='Random inputs in the parity check')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Largest allowed depth difference in meters')
+    args = parser.parse_args()
+
+    model = load_depth_model('cpu', args.checkpoint)
+    export(model, args.out, args.opset)
+
+    reference = MetricDepthOutput(model)
+    exported = OnnxDepthModel(args.out, sessions=1)
+    errors = []
+    with torch.no_grad():
+        for image in parity_inputs(args.images, args.random):
+            expected = reference(image).numpy()
+            actual = exported(image)['metric_depth'].numpy()
+            errors.append(np.abs(expected - actual).max())
+            print(f'batch {image.shape[0]}: max abs error {errors[-1]:.2e} m, '
+                  f'mean {np.abs(expected - actual).mean():.2e} m')
+    if max(errors) > args.atol:
+        print(f'parity failed: {max(errors):.2e} m > {args.atol:.2e} m')
+        sys.exit(1)
+    print(f'parity ok: max abs error {max(errors):.2e} m')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Exports the pickled sklearn mass regression to the numpy arrays mass_predictor.ArrayRegressor
+# evaluates, and checks that both give the same predictions. Run from the calorie_estimation directory:
+#   python tools/export_regression_model.py
+# model_registry loads the .npz instead of the .pkl on the next start. Exits non-zero on a mismatch.
+
+import argparse
+import os
+import sys
+
+import joblib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mass_predictor import FEATURE_NAMES, ArrayRegressor
+
+
+def parity_rows(count, seed=0):
+    # Rows shaped like regression_features output: class ids of the YOLO model, areas in cm^2
+    # and volumes in cm^3, plus the degenerate zero rows an empty mask produces
+    rng = np.random.default_rng(seed)
+    rows = np.column_stack([
+        rng.integers(0, 80, count),
+        rng.uniform(0, 600, count),
+        rng.exponential(500, count),
+    ]).astype(np.float64)
+    rows[:8, 1:] = 0
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the mass regression model to numpy arrays')
+    parser.add_argument('--model', type=str, default='./data/models/regression_model.pkl')
+    parser.add_argument('--out', type=str, default='./data/models/regression_model.npz')
+    parser.add_argument('--rows', type=int, default=10000, help='Random rows compared against the sklearn model')
+    parser.add_argument('--atol', type=float, default=1e-6)
+    args = parser.parse_args()
+
+    estimator = joblib.load(args.model)
+    regressor = ArrayRegressor.from_estimator(estimator)
+    regressor.save(args.out)
+    regressor = ArrayRegressor.load(args.out)
+
+    rows = parity_rows(args.rows)
+    expected = estimator.predict(pd.DataFrame(rows, columns=FEATURE_NAMES))
+    actual = regressor.predict(rows)
+    error = np.abs(expected - actual)
+    print(f'{type(estimator).__name__}: wrote {args.out}, max abs error {error.max():.3g} over {len(rows)} rows')
+    if not np.allclose(expected, actual, rtol=0, atol=args.atol):
+        print(f'{int((error > args.atol).sum())} rows differ by more than {args.atol}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Accuracy of the reduced-precision modes against fp32. For every model and precision the
+# model is loaded again, set up with precision.apply_precision and run on the same images while the
+# other models stay in fp32. Reports weight memory, detection, mask and depth differences and
+# the resulting change in the estimated masses. Run from the calorie_estimation directory:
+#   python tools/precision_report.py --images photos/ --output precision_report.json
+# Without --images, synthetic plates from benchmarks/load_replay.py are used.
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# The reference models must be fp32 whatever the environment asks for
+for variable in ('SAM_PRECISION', 'DEPTH_PRECISION', 'YOLO_PRECISION'):
+    os.environ[variable] = 'fp32'
+
+MODELS = ['sam_model', 'depth_model', 'yolo_model']
+
+
+def load_frames(image_dir, count):
+    from image_frame import ImageFrame
+    if image_dir is None:
+        from benchmarks.load_replay import synthesize_payload
+        rng = np.random.default_rng(0)
+        return [ImageFrame.from_bytes(synthesize_payload(rng)['image']) for _ in range(count)]
+    frames = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+        with open(path, 'rb') as f:
+            frames.append(ImageFrame.from_bytes(f.read()))
+    return frames
+
+
+def weight_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def run(estimator, frame, detections):
+    # Detections, masks, depth map and masses of one image
+    if detections is None:
+        detections = estimator.yolo_object_detection(frame, prefetch=False)
+    estimator.mask_predictor.reset_image()
+    segmentation = estimator.perform_segmentation(frame, detections)
+    depth_map = estimator.depth_estimation(frame)  # Centimeters
+    try:
+        results = estimator.calculate_volume_and_mass(segmentation, depth_map)
+    except ValueError:
+        results = []  # No coin found, only the masks and depth are compared
+    masses = {result['instance_id']: float(result['mass']) for result in results}
+    return detections, segmentation['masks'], depth_map.astype(np.float64) / 100, masses
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def compare(reference, candidate):
+    ref_detections, ref_masks, ref_depth, ref_masses = reference
+    detections, masks, depth, masses = candidate
+    diff = {
+        'depth_abs_err_mean_m': float(np.abs(depth - ref_depth).mean()),
+        'depth_abs_err_max_m': float(np.abs(depth - ref_depth).max()),
+        'depth_rel_err_mean': float((np.abs(depth - ref_depth) / np.maximum(ref_depth, 1e-6)).mean()),
+    }
+    if len(detections) == len(ref_detections):
+        diff['box_abs_err_max_px'] = float(max((np.abs(np.subtract(d['bbox'], r['bbox'])).max()
+                                               for d, r in zip(detections, ref_detections)), default=0))
+        diff['mask_iou_min'] = float(min((mask_iou(m, r) for m, r in zip(masks, ref_masks)), default=1.0))
+    else:
+        diff['detection_count_changed'] = True
+    shared = [i for i in ref_masses if i in masses]
+    if shared:
+        errors = [abs(masses[i] - ref_masses[i]) / max(abs(ref_masses[i]), 1e-6) for i in shared]
+        diff['mass_rel_err_mean'] = float(np.mean(errors))
+        diff['mass_rel_err_max'] = float(np.max(errors))
+    return diff
+
+
+def summarize(diffs):
+    keys = sorted({key for diff in diffs for key in diff})
+    summary = {}
+    for key in keys:
+        values = [diff[key] for diff in diffs if key in diff]
+        if key == 'detection_count_changed':
+            summary['images_with_detection_count_changed'] = len(values)
+        elif key.endswith('_min'):
+            summary[key] = min(values)
+        elif key.endswith('_max') or key.endswith('_max_m') or key.endswith('_max_px'):
+            summary[key] = max(values)
+        else:
+            summary[key] = float(np.mean(values))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare reduced-precision inference against fp32')
+    parser.add_argument('--images', type=str, default=None, help='Directory of food photos, synthetic plates if omitted')
+    parser.add_argument('--synthesize', type=int, default=8)
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--precisions', nargs='+', default=['fp16', 'bf16', 'fp16-cast', 'bf16-cast'])
+    parser.add_argument('--output', type=str, default=None, help='Write the report as JSON')
+    parser.add_argument('--max-mass-rel-error', type=float, default=None,
+                        help='Exit non-zero when the mean relative mass error of any mode exceeds this')
+    args = parser.parse_args()
+
+    import torch
+    from async_utility import CalorieEstimator, model_manager
+    from model_registry import model_registry
+    from precision import apply_precision
+
+    device = model_manager.devices[0]
+    if device in model_manager.cpu_workers:
+        device = torch.device('cpu')
+    reference_models = dict(model_manager.get_models(device), depth_batcher=None, mass_predictor=None)
+    frames = load_frames(args.images, args.synthesize)
+
+    # Detections come from fp32 YOLO unless YOLO itself is under test, so the other models see the same boxes
+    reference_estimator = CalorieEstimator(reference_models, device)
+    references = [run(reference_estimator, frame, None) for frame in frames]
+
+    report = {'device': str(device), 'images': len(frames), 'modes': []}
+    failed = False
+    for name in args.models:
+        for precision in args.precisions:
+            entry = {'model': name, 'precision': precision,
+                     'weight_mib_fp32': weight_bytes(reference_models[name]) / 1024 ** 2}
+            try:
+                # A fresh load, not a deepcopy: the reference's forwards may already be wrapped, e.g.
+                # by protect_fp32_modules, and copied wrappers would still call the reference's modules
+                model = apply_precision(name, model_registry.loaders[name](device), device, precision)
+                estimator = CalorieEstimator(dict(reference_models, **{name: model}), device)
+                diffs = [compare(reference, run(estimator, frame, None if name == 'yolo_model' else reference[0]))
+                         for frame, reference in zip(frames, references)]
+            except Exception as e:
+                entry['error'] = repr(e)
+                report['modes'].append(entry)
+                print(f'{name:12s} {precision:10s} failed: {e!r}')
+                continue
+            entry['weight_mib'] = weight_bytes(model) / 1024 ** 2
+            entry.update(summarize(diffs))
+            report['modes'].append(entry)
+            del model, estimator
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            print(f"{name:12s} {precision:10s} weights {entry['weight_mib']:8.1f} MiB "
+                  f"(fp32 {entry['weight_mib_fp32']:.1f})  depth err {entry['depth_abs_err_mean_m'] * 100:.2f} cm  "
+                  f"mass err {100 * entry.get('mass_rel_err_mean', 0):.2f}% (max "
+                  f"{100 * entry.get('mass_rel_err_max', 0):.2f}%)")
+            if args.max_mass_rel_error is not None and entry.get('mass_rel_err_mean', 0) > args.max_mass_rel_error:
+                failed = True
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
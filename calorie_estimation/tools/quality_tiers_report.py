@@ -0,0 +1,153 @@
+# Accuracy and latency of every quality tier on a held-out set. Each tier runs SAM, ZoeDepth and
+# the mass regression on the same payloads and detections as the most accurate tier, which is the
+# reference. Reports p50/p95 latency, depth and mask differences and the change in the estimated
+# masses, and the error against ground-truth masses when labels are given. Run from the
+# calorie_estimation directory:
+#   python tools/quality_tiers_report.py --payloads heldout/ --labels heldout/masses.json --output tiers.json
+# --payloads is a directory written by benchmarks/load_replay.py --record, without it synthetic plates
+# are used. --labels maps the payload file name (0000, 0001, ...) to {instance_id: grams}.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def load_payloads(payload_dir, count):
+    if payload_dir is None:
+        from benchmarks.load_replay import synthesize_payload
+        rng = np.random.default_rng(0)
+        return [synthesize_payload(rng) for _ in range(count)]
+    from benchmarks.load_replay import load_payloads as load
+    return load(payload_dir)
+
+
+def run(estimator, frame, detections, device):
+    # Masks, depth map in meters, masses and latency of one image at the estimator's tier
+    import torch
+    estimator.mask_predictor.reset_image()
+    started = time.perf_counter()
+    segmentation = estimator.perform_segmentation(frame, detections)
+    depth_map = estimator.depth_estimation(frame, detections)  # Centimeters
+    try:
+        results = estimator.calculate_volume_and_mass(segmentation, depth_map)
+    except ValueError:
+        results = []  # No coin found, only the masks and depth are compared
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    latency = 1000 * (time.perf_counter() - started)
+    masses = {str(result['instance_id']): float(result['mass']) for result in results}
+    return segmentation['masks'], depth_map.astype(np.float64) / 100, masses, latency
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def mass_errors(masses, reference):
+    shared = [i for i in reference if i in masses]
+    return [abs(masses[i] - reference[i]) / max(abs(reference[i]), 1e-6) for i in shared]
+
+
+def compare(reference, candidate, labels):
+    ref_masks, ref_depth, ref_masses, _ = reference
+    masks, depth, masses, _ = candidate
+    diff = {
+        'depth_abs_err_mean_m': float(np.abs(depth - ref_depth).mean()),
+        'mask_iou_mean': float(np.mean([mask_iou(m, r) for m, r in zip(masks, ref_masks)] or [1.0])),
+        'mass_rel_err': mass_errors(masses, ref_masses),
+    }
+    if labels is not None:
+        diff['label_rel_err'] = mass_errors(masses, labels)
+    return diff
+
+
+def summarize(tier, settings, diffs, latencies):
+    entry = dict(settings, tier=tier, images=len(latencies),
+                 latency_p50_ms=float(np.percentile(latencies, 50)),
+                 latency_p95_ms=float(np.percentile(latencies, 95)),
+                 depth_abs_err_mean_m=float(np.mean([d['depth_abs_err_mean_m'] for d in diffs])),
+                 mask_iou_mean=float(np.mean([d['mask_iou_mean'] for d in diffs])))
+    for key in ('mass_rel_err', 'label_rel_err'):
+        errors = [e for d in diffs for e in d.get(key, [])]
+        if errors:
+            entry[f'{key}_mean'] = float(np.mean(errors))
+            entry[f'{key}_max'] = float(np.max(errors))
+    return entry
+
+
+def print_table(entries):
+    print('| tier | sam size | depth size | precision | p50 ms | p95 ms | depth err cm | mask IoU '
+          '| mass err vs full | mass err vs labels |')
+    print('|---|---|---|---|---|---|---|---|---|---|')
+    for e in entries:
+        labels = f"{100 * e['label_rel_err_mean']:.2f}%" if 'label_rel_err_mean' in e else '-'
+        depth_size = 'x'.join(map(str, e['depth_size'])) if e['depth_size'] else 'model'
+        print(f"| {e['tier']} | {e['sam_size']} | {depth_size} | {e['precision']} "
+              f"| {e['latency_p50_ms']:.1f} | {e['latency_p95_ms']:.1f} | {100 * e['depth_abs_err_mean_m']:.2f} "
+              f"| {e['mask_iou_mean']:.3f} | {100 * e.get('mass_rel_err_mean', 0):.2f}% | {labels} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy and latency of the quality tiers on a held-out set')
+    parser.add_argument('--payloads', type=str, default=None, help='Directory written by load_replay.py --record')
+    parser.add_argument('--labels', type=str, default=None, help='JSON of ground-truth masses per payload')
+    parser.add_argument('--synthesize', type=int, default=8)
+    parser.add_argument('--tiers', nargs='+', default=None, help='Tiers to compare, all by default')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed passes per tier')
+    parser.add_argument('--output', type=str, default=None, help='Write the report as JSON')
+    args = parser.parse_args()
+
+    import torch
+    from async_utility import CalorieEstimator, model_manager
+    from image_frame import ImageFrame
+    from quality_tiers import QUALITY_TIERS, BEST_TIER
+
+    device = model_manager.devices[0]
+    if device in model_manager.cpu_workers:
+        device = torch.device('cpu')
+    models = dict(model_manager.get_models(device), depth_batcher=None, mass_predictor=None)
+    estimator = CalorieEstimator(models, device)
+
+    payloads = load_payloads(args.payloads, args.synthesize)
+    frames = [ImageFrame.from_bytes(payload['image']) for payload in payloads]
+    labels = [None] * len(payloads)
+    if args.labels:
+        with open(args.labels) as f:
+            by_name = json.load(f)
+        labels = [{str(k): float(v) for k, v in by_name[f'{i:04d}'].items()} if f'{i:04d}' in by_name else None
+                  for i in range(len(payloads))]
+
+    tiers = args.tiers or list(QUALITY_TIERS)
+    outputs = {}
+    with torch.no_grad():
+        for tier in dict.fromkeys([BEST_TIER] + tiers):
+            estimator.use_tier(tier, forced=True)
+            for frame, payload in zip(frames[:args.warmup], payloads):
+                run(estimator, frame, payload['detections'], device)
+            outputs[tier] = [run(estimator, frame, payload['detections'], device)
+                             for frame, payload in zip(frames, payloads)]
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    report = {'device': str(device), 'images': len(frames), 'reference': BEST_TIER, 'tiers': []}
+    for tier in tiers:
+        diffs = [compare(reference, candidate, label)
+                 for reference, candidate, label in zip(outputs[BEST_TIER], outputs[tier], labels)]
+        report['tiers'].append(summarize(tier, QUALITY_TIERS[tier], diffs, [out[3] for out in outputs[tier]]))
+    print(f"device: {device}  images: {len(frames)}  reference: {BEST_TIER}")
+    print_table(report['tiers'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()